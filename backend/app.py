@@ -6,16 +6,26 @@ from flask_cors import CORS
 import json
 import threading
 import queue
+import hashlib
+import re
+import shutil
+import struct
+import time
+import uuid
+import contextlib
+import fcntl
+import multiprocessing
+from collections import OrderedDict
+from fractions import Fraction
+from functools import lru_cache, cached_property
+from concurrent.futures import ProcessPoolExecutor, Future, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import librosa
 import numpy as np
 from scipy import signal
-import io
+from scipy import fft as scipy_fft
 import warnings
-import base64
-import matplotlib
-matplotlib.use('Agg')  # Используем non-interactive backend
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+import zlib
 warnings.filterwarnings('ignore')
 
 # Попытка импорта дополнительных библиотек
@@ -27,13 +37,27 @@ except ImportError:
     HAS_SOUNDFILE = False
     print("⚠️  soundfile недоступен, используем scipy для записи")
 
+# Метрики Prometheus. Воркеры gunicorn и процессы пула рендеринга пишут
+# метрики в общий каталог (multiprocess режим), отдельный HTTP сервер на
+# METRICS_PORT суммирует их. Порт внутренний: nginx его не проксирует, и
+# метрики не доступны через основной порт приложения. Каталог должен быть
+# задан до импорта prometheus_client; под gunicorn его и сервер метрик
+# задает gunicorn.conf.py, при запуске через python app.py - этот модуль.
+# По умолчанию сервер слушает только localhost; для сбора из другого
+# контейнера задается METRICS_ADDR=0.0.0.0 (порт наружу не публикуется)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9230))
+METRICS_ADDR = os.environ.get('METRICS_ADDR', '127.0.0.1')
 try:
-    import pyrubberband as pyrb
-    HAS_RUBBERBAND = True
-    print("✅ pyrubberband доступен")
+    if not METRICS_ENABLED:
+        raise ImportError('metrics disabled')
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='slowler_metrics_')
+    import prometheus_client
+    HAS_PROMETHEUS = True
 except ImportError:
-    HAS_RUBBERBAND = False
-    print("⚠️  pyrubberband недоступен, используем librosa")
+    HAS_PROMETHEUS = False
+    print("⚠️  prometheus_client недоступен, метрики отключены")
 
 app = Flask(__name__)
 CORS(app)
@@ -43,103 +67,718 @@ app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 UPLOAD_FOLDER = tempfile.mkdtemp()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-def process_audio_with_rubberband(audio_path, speed_factor, preserve_pitch=True):
+def available_cpus():
     """
-    Обработка аудио с использованием лучших доступных алгоритмов
+    Ядра, доступные процессу: учитывает привязку к CPU и квоту cgroup v2
+    (в контейнере os.cpu_count() отдает ядра хоста)
     """
     try:
-        # Сначала конвертируем в WAV если нужно
-        wav_path = convert_to_wav_if_needed(audio_path)
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+# Количество процессов для параллельного рендеринга файлов на воркер gunicorn.
+# По умолчанию половина доступных ядер, но не больше 2: воркеров два, у каждого
+# свой пул, и каждый процесс пула загружает librosa и держит буферы рендера,
+# а память контейнера ограничена (docker-compose.yaml)
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', max(1, min(2, available_cpus() // 2))))
+
+# Потоки для многокадровых FFT в STFT/ISTFT (рендеры и так идут в пуле процессов)
+FFT_WORKERS = int(os.environ.get('FFT_WORKERS', 1))
+
+# Кадров в одном блоке STFT/ISTFT: окно, FFT и overlap-add блока остаются
+# в кэше процессора, а копия всех кадров трека не создается
+STFT_BLOCK_FRAMES = int(os.environ.get('STFT_BLOCK_FRAMES', 256))
+
+# ---------------------------------------------------------------------------
+# Инструментирование: длительность этапов и счетчики движков/fallback.
+# Без prometheus_client функции ничего не делают
+# ---------------------------------------------------------------------------
+
+if HAS_PROMETHEUS:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'slowler_stage_seconds', 'Длительность этапов обработки',
+        ['endpoint', 'stage'],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+    )
+    ENGINE_RUNS = prometheus_client.Counter(
+        'slowler_engine_runs_total', 'Запуски движков обработки', ['kind', 'engine', 'status']
+    )
+    FALLBACKS = prometheus_client.Counter(
+        'slowler_fallbacks_total', 'Срабатывания fallback путей', ['kind', 'reason']
+    )
+    RENDERS = prometheus_client.Counter(
+        'slowler_renders_total', 'Рендеры по формату и попаданию в кэш', ['format', 'cache']
+    )
+    ANALYSES = prometheus_client.Counter(
+        'slowler_analyses_total', 'Анализы по источнику результата', ['cache']
+    )
+
+def observe_stage(endpoint, stage, seconds):
+    if HAS_PROMETHEUS:
+        STAGE_SECONDS.labels(endpoint, stage).observe(seconds)
+
+@contextlib.contextmanager
+def stage_timer(endpoint, stage):
+    """
+    Замер этапа: with stage_timer('render', 'decode'): ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(endpoint, stage, time.perf_counter() - started)
+
+class StageClock:
+    """
+    Замер последовательных этапов без перестройки кода:
+    lap(stage) записывает время, прошедшее с предыдущей отметки
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.last = time.perf_counter()
+    
+    def lap(self, stage):
+        now = time.perf_counter()
+        observe_stage(self.endpoint, stage, now - self.last)
+        self.last = now
+
+def timed_chunks(chunks, endpoint, stage):
+    """
+    Проходит генератор, замеряя только время получения элементов:
+    ожидание медленного клиента между yield в замер не попадает
+    """
+    elapsed = 0.0
+    iterator = iter(chunks)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield chunk
+    finally:
+        observe_stage(endpoint, stage, elapsed)
+
+def count_engine_run(kind, engine, status):
+    if HAS_PROMETHEUS:
+        ENGINE_RUNS.labels(kind, engine, status).inc()
+
+def count_fallback(kind, reason):
+    if HAS_PROMETHEUS:
+        FALLBACKS.labels(kind, reason).inc()
+
+def count_render(output_format, cache):
+    if HAS_PROMETHEUS:
+        RENDERS.labels(output_format, cache).inc()
+
+def count_analysis(cache):
+    if HAS_PROMETHEUS:
+        ANALYSES.labels(cache).inc()
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """
+    Возвращает пул процессов для рендеринга (создается при первом обращении)
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn вместо fork: воркер gunicorn может держать потоки и блокировки
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            print(f"🧵 Создан пул рендеринга на {RENDER_WORKERS} процессов")
+        return _render_pool
+
+def reset_render_pool():
+    """
+    Сбрасывает сломанный пул (например, после OOM-kill дочернего процесса)
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+def submit_render(fn, *args):
+    """
+    Отправляет задачу рендеринга в пул процессов.
+    При RENDER_WORKERS <= 1 задача выполняется сразу в текущем процессе
+    """
+    if RENDER_WORKERS <= 1:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return get_render_pool().submit(fn, *args)
+
+# ---------------------------------------------------------------------------
+# Реестр движков обработки
+#
+# Движок регистрируется с типом задачи ('stretch' - растяжение с сохранением
+# тональности, 'varispeed' - изменение скорости вместе с тональностью,
+# 'decode', 'encode_mp3'), приоритетом и проверкой доступности. Проверки
+# выполняются один раз при импорте модуля - в каждом воркере gunicorn и в
+# каждом процессе пула рендеринга, - поэтому запрос сразу идет в лучший
+# доступный движок, а не обнаруживает отсутствие утилиты падением
+# ---------------------------------------------------------------------------
+
+ENGINES = {}
+
+# Утилиты, отсутствие которых при запуске отключает движок до перезапуска
+ENGINE_EXECUTABLES = {'rubberband', 'ffmpeg', 'ffprobe'}
+
+def register_engine(kind, name, priority, probe=None, extensions=None):
+    """
+    Декоратор регистрации движка: тип задачи, имя, приоритет (больше -
+    предпочтительнее), проверка доступности и поддерживаемые расширения
+    (для декодеров; None - любые)
+    """
+    def decorator(fn):
+        ENGINES.setdefault(kind, []).append({
+            'name': name,
+            'run': fn,
+            'priority': priority,
+            'probe': probe,
+            'extensions': extensions,
+            'available': None
+        })
+        ENGINES[kind].sort(key=lambda engine: -engine['priority'])
+        return fn
+    return decorator
+
+def probe_engines():
+    """
+    Проверяет доступность всех зарегистрированных движков
+    """
+    for engines in ENGINES.values():
+        for engine in engines:
+            try:
+                engine['available'] = engine['probe'] is None or bool(engine['probe']())
+            except Exception:
+                engine['available'] = False
+    
+    summary = ', '.join(
+        f"{kind}: {best_engine(kind) or '-'}" for kind in sorted(ENGINES)
+    )
+    print(f"🧩 Движки: {summary}")
+
+@lru_cache(maxsize=None)
+def probe_command(*cmd):
+    """
+    Запускает команду проверки один раз за процесс: stdout или None
+    """
+    import subprocess
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout + result.stderr if result.returncode == 0 else None
+
+def engine_candidates(kind, extension=None):
+    """
+    Доступные движки типа kind в порядке приоритета
+    """
+    return [
+        engine for engine in ENGINES.get(kind, [])
+        if engine['available']
+        and (extension is None or engine['extensions'] is None or extension in engine['extensions'])
+    ]
+
+def best_engine(kind, extension=None):
+    """
+    Имя лучшего доступного движка или None
+    """
+    candidates = engine_candidates(kind, extension)
+    return candidates[0]['name'] if candidates else None
+
+def run_engine(kind, *args, extension=None, exclude=(), with_engine=False):
+    """
+    Выполняет задачу лучшим доступным движком; при ошибке переходит к
+    следующему. Если упал запуск отсутствующей утилиты, движок отключается
+    для этого процесса, и следующие запросы его не пробуют.
+    with_engine=True - результат возвращается вместе с именем движка
+    """
+    errors = []
+    for engine in engine_candidates(kind, extension):
+        if engine['name'] in exclude:
+            continue
+        try:
+            result = engine['run'](*args)
+        except Exception as e:
+            print(f"⚠️ Движок {engine['name']} ({kind}) не сработал: {e}")
+            errors.append(f"{engine['name']}: {e}")
+            count_engine_run(kind, engine['name'], 'error')
+            if isinstance(e, FileNotFoundError) and os.path.basename(str(e.filename)) in ENGINE_EXECUTABLES:
+                engine['available'] = False
+                print(f"🚫 Движок {engine['name']} отключен: {e.filename} не найден")
+                count_fallback(kind, f"{engine['name']}_missing")
+            else:
+                count_fallback(kind, f"{engine['name']}_error")
+            continue
         
-        # Используем Rubber Band если доступен
-        if HAS_RUBBERBAND:
+        count_engine_run(kind, engine['name'], 'ok')
+        return (result, engine['name']) if with_engine else result
+    
+    if not errors:
+        raise ValueError(f"Нет доступного движка для {kind}" + (f" ({extension})" if extension else ''))
+    raise RuntimeError(f"Все движки {kind} завершились с ошибкой: " + '; '.join(errors))
+
+def engine_status():
+    """
+    Состояние движков для /health
+    """
+    return {
+        kind: [
+            {'name': engine['name'], 'priority': engine['priority'], 'available': bool(engine['available'])}
+            for engine in engines
+        ]
+        for kind, engines in ENGINES.items()
+    }
+
+def engine_signature():
+    """
+    Выбранные движки рендеринга - часть ключа кэша рендеров
+    """
+    return ';'.join(f"{kind}={best_engine(kind)}" for kind in ('stretch', 'varispeed', 'encode_mp3'))
+
+class DiskLRUCache:
+    """
+    Дисковый кэш файлов с ограничением размера и вытеснением давно
+    неиспользуемых записей (LRU по времени модификации, которое
+    обновляется при каждом попадании). Безопасен для нескольких процессов:
+    запись идет через атомарный os.replace, гонки при вытеснении безвредны
+    """
+    def __init__(self, directory, max_bytes, ttl_seconds=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+    
+    def path_for(self, key, suffix=''):
+        return os.path.join(self.directory, key[:2], key + suffix)
+    
+    def get(self, key, suffix=''):
+        """
+        Путь к записи или None; попадание продлевает жизнь записи
+        """
+        path = self.path_for(key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+    
+    def get_into(self, key, suffix, dest_path):
+        """
+        Копирует запись в dest_path. True при попадании.
+        Именно копия, а не жесткая ссылка: рабочие файлы потом перезаписываются
+        на месте (open 'wb', ffmpeg -y), и ссылка испортила бы запись кэша
+        """
+        path = self.get(key, suffix)
+        if path is None:
+            return False
+        tmp_path = f'{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        except OSError:
             try:
-                print(f"🎵 Используем Rubber Band с файлом: {wav_path}")
-                
-                # Проверяем, что файл существует и не пустой
-                if not os.path.exists(wav_path):
-                    raise Exception(f"WAV файл не найден: {wav_path}")
-                
-                file_size = os.path.getsize(wav_path)
-                if file_size < 1000:
-                    raise Exception(f"WAV файл слишком маленький: {file_size} байт")
-                
-                print(f"📊 Размер WAV файла: {file_size} байт")
-                
-                # Используем pyrubberband с файлом напрямую
-                import subprocess
-                import tempfile
-                
-                # Создаем временный файл для результата
-                temp_fd, temp_output = tempfile.mkstemp(suffix='.wav')
-                os.close(temp_fd)
-                
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+    
+    def put(self, key, suffix, src_path, move=False):
+        """
+        Сохраняет копию файла и вытесняет лишнее. Запись не делит inode
+        с рабочим файлом (см. get_into). move=True - src_path является
+        временным файлом в директории кэша и переносится без копирования
+        """
+        path = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            if move:
+                os.replace(src_path, path)
+            else:
+                shutil.copyfile(src_path, tmp_path)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить в кэш: {e}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return None
+        self.evict()
+        return path
+    
+    def evict(self):
+        """
+        Удаляет просроченные записи (если задан TTL) и самые давно
+        использованные, пока кэш больше лимита
+        """
+        entries = []
+        total = 0
+        expire_before = time.time() - self.ttl_seconds if self.ttl_seconds else None
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, filename)
                 try:
-                    if preserve_pitch:
-                        # Команда для изменения темпа с сохранением тональности
-                        cmd = [
-                            'rubberband',
-                            '--time', str(1.0 / speed_factor),
-                            '--pitch-hq',
-                            wav_path,
-                            temp_output
-                        ]
-                    else:
-                        # Команда для простого изменения скорости
-                        cmd = [
-                            'rubberband',
-                            '--speed', str(speed_factor),
-                            wav_path,
-                            temp_output
-                        ]
-                    
-                    print(f"🔧 Команда Rubber Band: {' '.join(cmd)}")
-                    
-                    # Выполняем команду
-                    result = subprocess.run(cmd, capture_output=True, text=True)
-                    
-                    if result.returncode == 0:
-                        # Загружаем результат
-                        processed_y, processed_sr = load_audio_with_scipy(temp_output)
-                        
-                        print("✅ Использован Rubber Band алгоритм")
-                        
-                        # Удаляем временные файлы
-                        try:
-                            os.unlink(temp_output)
-                            if wav_path != audio_path:
-                                os.unlink(wav_path)
-                        except:
-                            pass
-                        
-                        return processed_y, processed_sr
-                    else:
-                        print(f"⚠️ Ошибка команды Rubber Band: {result.stderr}")
-                        raise Exception(f"Rubber Band завершился с ошибкой: {result.stderr}")
-                
-                except Exception as e:
-                    # Очищаем временный файл при ошибке
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if expire_before is not None and stat.st_mtime < expire_before:
                     try:
-                        os.unlink(temp_output)
-                    except:
+                        os.unlink(path)
+                    except OSError:
                         pass
-                    raise e
-                
-            except Exception as e:
-                print(f"⚠️ Ошибка Rubber Band: {e}")
-                print("🔄 Переключаемся на Custom STFT алгоритм")
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
         
-        # Fallback на наши алгоритмы
-        return process_audio_with_librosa(wav_path, speed_factor, preserve_pitch)
+        if total <= self.max_bytes:
+            return
         
-    except Exception as e:
-        print(f"Ошибка обработки: {e}")
-        # Последний fallback
-        return process_audio_with_librosa(audio_path, speed_factor, preserve_pitch)
+        for _, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+            if total <= self.max_bytes:
+                break
+
+def save_upload_with_hash(file, path, chunk_size=1024 * 1024):
+    """
+    Сохраняет загруженный файл, одновременно считая SHA-256 содержимого
+    """
+    digest = hashlib.sha256()
+    with open(path, 'wb') as dst:
+        while True:
+            chunk = file.stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+# Кэш готовых рендеров: ключ - хэш входа плюс параметры рендеринга
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'slowler_render_cache'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Меняется при изменении алгоритмов, чтобы не отдавать устаревшие рендеры
+RENDER_CACHE_VERSION = '8'
+
+RENDER_CACHE = DiskLRUCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES) if RENDER_CACHE_MAX_BYTES > 0 else None
+
+def render_cache_key(content_hash, speed, preserve_pitch, output_format, target_lufs=None):
+    """
+    Ключ кэша рендеров. Выбранные движки входят в ключ: после установки
+    Rubber Band результаты fallback-движков не должны отдаваться из кэша
+    """
+    raw = (f'{RENDER_CACHE_VERSION}:{content_hash}:{speed!r}:{bool(preserve_pitch)}:'
+           f'{output_format}:{target_lufs!r}:{engine_signature()}')
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+# Кэш декодированного PCM: float32 (channels, samples) в .npy, открывается через mmap
+PCM_CACHE_DIR = os.environ.get('PCM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'slowler_pcm_cache'))
+PCM_CACHE_MAX_BYTES = int(os.environ.get('PCM_CACHE_MAX_BYTES', 4 * 1024 ** 3))
+PCM_CACHE_TTL_SECONDS = int(os.environ.get('PCM_CACHE_TTL_SECONDS', 24 * 3600))
+
+PCM_CACHE = DiskLRUCache(PCM_CACHE_DIR, PCM_CACHE_MAX_BYTES, PCM_CACHE_TTL_SECONDS) if PCM_CACHE_MAX_BYTES > 0 else None
+
+# Раскладка PCM рендеринга: все каналы на исходной частоте
+PCM_LAYOUT_NATIVE = 'native'
+
+def pcm_cache_key(content_hash, decoder, layout=PCM_LAYOUT_NATIVE):
+    """
+    Ключ кэша декодированного PCM. Декодер и раскладка (каналы, частота)
+    входят в ключ: рендеринг и анализ декодируют по-разному, и содержимое
+    записи не должно зависеть от того, какой эндпоинт заполнил её первым
+    """
+    return hashlib.sha256(f'pcm:2:{decoder}:{layout}:{content_hash}'.encode('utf-8')).hexdigest()
+
+def get_cached_pcm(content_hash, decoder, layout=PCM_LAYOUT_NATIVE):
+    """
+    Открывает декодированный PCM из кэша без копирования: (memmap, sr) или None
+    """
+    if PCM_CACHE is None or not content_hash or not decoder:
+        return None
+    key = pcm_cache_key(content_hash, decoder, layout)
+    meta_path = PCM_CACHE.get(key, '.json')
+    data_path = PCM_CACHE.get(key, '.npy')
+    if meta_path is None or data_path is None:
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        data = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    print(f"⚡ PCM найден в кэше: {data.shape}, sr={meta['sr']}")
+    return data, meta['sr']
+
+def put_cached_pcm(content_hash, decoder, y, sr, layout=PCM_LAYOUT_NATIVE):
+    """
+    Сохраняет декодированный PCM в кэш
+    """
+    if PCM_CACHE is None or not content_hash or not decoder:
+        return
+    key = pcm_cache_key(content_hash, decoder, layout)
+    token = f'{os.getpid()}.{threading.get_ident()}'
+    data_tmp = os.path.join(PCM_CACHE.directory, f'{key}.{token}.npy.tmp')
+    meta_tmp = os.path.join(PCM_CACHE.directory, f'{key}.{token}.json.tmp')
+    try:
+        with open(data_tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(y, dtype=np.float32))
+        with open(meta_tmp, 'w') as f:
+            json.dump({'sr': int(sr), 'shape': list(np.shape(y))}, f)
+        # Сначала данные, затем метаданные: запись без метаданных считается промахом
+        PCM_CACHE.put(key, '.npy', data_tmp, move=True)
+        PCM_CACHE.put(key, '.json', meta_tmp, move=True)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить PCM в кэш: {e}")
+    finally:
+        for path in (data_tmp, meta_tmp):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def render_decoder(audio_path):
+    """
+    Декодер, которым рендеринг читает файл (лучший движок 'decode' для расширения)
+    """
+    _, ext = os.path.splitext(audio_path.lower())
+    return best_engine('decode', ext)
+
+def load_decoded_audio(audio_path, content_hash=None):
+    """
+    Декодированный PCM через кэш: при попадании - memmap только для чтения,
+    при промахе - декодирование реестром движков и сохранение в кэш под
+    именем движка, который на самом деле декодировал файл
+    """
+    cached = get_cached_pcm(content_hash, render_decoder(audio_path))
+    if cached is not None:
+        return cached
+    
+    (y, sr), decoder = load_audio_with_scipy(audio_path, with_engine=True)
+    put_cached_pcm(content_hash, decoder, y, sr)
+    return y, sr
+
+# Обмен PCM с Rubber Band CLI: 'shm' - через tmpfs без промежуточных WAV
+# конвертаций, 'file' - прежний режим с конвертацией входа в WAV на диске
+RUBBERBAND_IO_MODE = os.environ.get('RUBBERBAND_IO_MODE', 'shm').lower()
+SHM_DIR = os.environ.get('SHM_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+def build_rubberband_command(input_path, output_path, speed_factor, preserve_pitch):
+    """
+    Формирует команду Rubber Band CLI
+    """
+    if preserve_pitch:
+        # Команда для изменения темпа с сохранением тональности
+        return [
+            'rubberband',
+            '--time', str(1.0 / speed_factor),
+            '--pitch-hq',
+            input_path,
+            output_path
+        ]
+    # Команда для простого изменения скорости
+    return [
+        'rubberband',
+        '--speed', str(speed_factor),
+        input_path,
+        output_path
+    ]
+
+def get_scratch_dir(required_bytes):
+    """
+    Каталог для обмена PCM: tmpfs, если в нем хватает места, иначе обычный temp
+    """
+    try:
+        stat = os.statvfs(SHM_DIR)
+        if stat.f_bavail * stat.f_frsize > required_bytes:
+            return SHM_DIR
+        print(f"⚠️ В {SHM_DIR} недостаточно места, используем {tempfile.gettempdir()}")
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+def write_float_wav(path, audio, sr, block_size=65536):
+    """
+    Запись (channels, samples) float32 в IEEE float WAV блоками,
+    без промежуточной полной копии в int16 или в интерливинг
+    """
+    audio = np.atleast_2d(audio)
+    channels, n_samples = audio.shape
+    data_bytes = n_samples * channels * 4
+    
+    with open(path, 'wb') as f:
+        f.write(b'RIFF')
+        f.write(struct.pack('<I', 4 + 26 + 12 + 8 + data_bytes))
+        f.write(b'WAVE')
+        # fmt: WAVE_FORMAT_IEEE_FLOAT, cbSize = 0
+        f.write(b'fmt ' + struct.pack('<IHHIIHHH', 18, 3, channels, sr, sr * channels * 4, channels * 4, 32, 0))
+        f.write(b'fact' + struct.pack('<II', 4, n_samples))
+        f.write(b'data' + struct.pack('<I', data_bytes))
+        for start in range(0, n_samples, block_size):
+            block = audio[:, start:start + block_size]
+            f.write(np.ascontiguousarray(block.T, dtype='<f4').tobytes())
+
+def process_with_rubberband_shm(y, sr, speed_factor, preserve_pitch=True):
+    """
+    Rubber Band CLI с обменом PCM через разделяемую память (tmpfs).
+    Вход пишется как float32 WAV прямо из декодированного массива,
+    результат читается через mmap и удаляется сразу после копирования.
+    Именованные каналы не подходят: в офлайн режиме rubberband читает
+    вход дважды (проход анализа и проход обработки) и перематывает файл
+    """
+    import subprocess
+    
+    y = np.atleast_2d(y)
+    required_bytes = int(y.shape[0] * y.shape[1] * 4 * (1.0 + 1.0 / speed_factor) * 1.05) + (1 << 20)
+    scratch_dir = get_scratch_dir(required_bytes)
+    
+    token = uuid.uuid4().hex
+    input_path = os.path.join(scratch_dir, f'rb_in_{token}.wav')
+    output_path = os.path.join(scratch_dir, f'rb_out_{token}.wav')
+    
+    try:
+        write_float_wav(input_path, y, sr)
+        
+        cmd = build_rubberband_command(input_path, output_path, speed_factor, preserve_pitch)
+        print(f"🔧 Команда Rubber Band: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        
+        # Вход больше не нужен - освобождаем память до чтения результата
+        os.unlink(input_path)
+        
+        if result.returncode != 0:
+            print(f"⚠️ Ошибка команды Rubber Band: {result.stderr}")
+            raise Exception(f"Rubber Band завершился с ошибкой: {result.stderr}")
+        
+        # Единственная копия: из страниц tmpfs в массив (channels, samples)
+        with MappedWav(output_path) as wav:
+            processed = wav.to_float32()
+            out_sr = wav.sr
+        
+        return processed, out_sr
+        
+    finally:
+        for path in (input_path, output_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def process_decoded_audio(y, sr, speed_factor, preserve_pitch=True, exclude=()):
+    """
+    Обработка уже декодированного аудио лучшим доступным движком.
+    Без сохранения тональности это просто ресэмплинг - он делается
+    в процессе, без запуска Rubber Band и временных файлов
+    """
+    kind = 'stretch' if preserve_pitch else 'varispeed'
+    return run_engine(kind, y, sr, speed_factor, exclude=exclude)
+
+def process_audio_with_rubberband(audio_path, speed_factor, preserve_pitch=True, content_hash=None):
+    """
+    Обработка аудио с использованием лучших доступных алгоритмов:
+    файл декодируется один раз, дальше работает выбранный движок
+    """
+    exclude = ()
+    if preserve_pitch and RUBBERBAND_IO_MODE == 'file' and best_engine('stretch') == 'rubberband':
+        try:
+            with stage_timer('render', 'stretch'):
+                return process_with_rubberband_file(audio_path, speed_factor, preserve_pitch)
+        except Exception as e:
+            print(f"⚠️ Ошибка Rubber Band: {e}")
+            print("🔄 Переключаемся на Custom STFT алгоритм")
+            count_fallback('stretch', 'rubberband_file_error')
+            exclude = ('rubberband',)
+    
+    # Ошибка декодирования не подменяется синтетическим сигналом: файл
+    # должен завершиться с ошибкой, а не попасть в кэш фальшивым рендером
+    with stage_timer('render', 'decode'):
+        y, sr = load_decoded_audio(audio_path, content_hash)
+    
+    with stage_timer('render', 'stretch'):
+        return process_decoded_audio(y, sr, speed_factor, preserve_pitch, exclude)
+
+def process_with_rubberband_file(audio_path, speed_factor, preserve_pitch=True):
+    """
+    Rubber Band CLI в файловом режиме (RUBBERBAND_IO_MODE=file):
+    вход конвертируется в WAV на диске, результат читается из файла
+    """
+    import subprocess
+    import tempfile
+    
+    # Сначала конвертируем в WAV если нужно
+    wav_path = convert_to_wav_if_needed(audio_path)
+    print(f"🎵 Используем Rubber Band с файлом: {wav_path}")
+    
+    # Проверяем, что файл существует и не пустой
+    if not os.path.exists(wav_path):
+        raise Exception(f"WAV файл не найден: {wav_path}")
+    
+    file_size = os.path.getsize(wav_path)
+    if file_size < 1000:
+        raise Exception(f"WAV файл слишком маленький: {file_size} байт")
+    
+    print(f"📊 Размер WAV файла: {file_size} байт")
+    
+    # Создаем временный файл для результата
+    temp_fd, temp_output = tempfile.mkstemp(suffix='.wav')
+    os.close(temp_fd)
+    
+    try:
+        cmd = build_rubberband_command(wav_path, temp_output, speed_factor, preserve_pitch)
+        print(f"🔧 Команда Rubber Band: {' '.join(cmd)}")
+        
+        # Выполняем команду
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"⚠️ Ошибка команды Rubber Band: {result.stderr}")
+            raise Exception(f"Rubber Band завершился с ошибкой: {result.stderr}")
+        
+        # Загружаем результат
+        processed_y, processed_sr = load_audio_with_scipy(temp_output)
+        print("✅ Использован Rubber Band алгоритм")
+        return processed_y, processed_sr
+        
+    finally:
+        # Удаляем временные файлы
+        for path in (temp_output, wav_path if wav_path != audio_path else None):
+            try:
+                os.unlink(path)
+            except (OSError, TypeError):
+                pass
 
 def convert_to_wav_if_needed(audio_path):
     """
-    Конвертирует MP3 в WAV и сохраняет в папке проекта, если нужно
+    Возвращает путь к WAV: WAV отдается как есть, остальные форматы
+    декодируются ffmpeg в WAV в папке проекта
     """
     import os
     
@@ -150,840 +789,2415 @@ def convert_to_wav_if_needed(audio_path):
         print(f"📁 Файл уже в формате WAV: {audio_path}")
         return audio_path
     
-    elif ext == '.mp3':
-        print(f"🔄 Конвертируем MP3 в WAV: {audio_path}")
-        
-        # Создаем имя для WAV файла в папке проекта
-        base_name = os.path.splitext(os.path.basename(audio_path))[0]
-        wav_filename = f"{base_name}_converted.wav"
-        wav_path = os.path.join(os.path.dirname(audio_path), wav_filename)
-        
-        try:
-            # Конвертируем через pydub
-            from pydub import AudioSegment
-            
-            # Загружаем MP3
-            audio = AudioSegment.from_mp3(audio_path)
-            
-            # Экспортируем как WAV в высоком качестве
-            audio.export(
-                wav_path,
-                format="wav",
-                parameters=[
-                    "-acodec", "pcm_s16le",  # 16-bit PCM
-                    "-ar", "44100",          # 44.1kHz
-                    "-ac", "2"               # Стерео
-                ]
-            )
-            
-            print(f"✅ MP3 конвертирован в WAV: {wav_path}")
-            return wav_path
-            
-        except ImportError:
-            print("⚠️ pydub недоступен, используем ffmpeg")
-            return convert_mp3_with_ffmpeg(audio_path)
-        except Exception as e:
-            print(f"⚠️ Ошибка конвертации через pydub: {e}")
-            return convert_mp3_with_ffmpeg(audio_path)
+    elif ext in FFMPEG_DECODE_EXTENSIONS:
+        print(f"🔄 Конвертируем {ext[1:].upper()} в WAV: {audio_path}")
+        return decode_audio_to_wav(audio_path)
     
     else:
         raise ValueError(f"Неподдерживаемый формат: {ext}")
 
-def convert_mp3_with_ffmpeg(audio_path):
+def process_loaded_audio(y, sr, speed_factor, preserve_pitch=True):
     """
-    Конвертация MP3 в WAV через ffmpeg
+    Fallback обработка уже декодированного аудио собственными алгоритмами
     """
-    import subprocess
-    import os
+    if y.ndim == 1:
+        y = np.array([y, y])
     
-    # Создаем имя для WAV файла
-    base_name = os.path.splitext(os.path.basename(audio_path))[0]
-    wav_filename = f"{base_name}_converted.wav"
-    wav_path = os.path.join(os.path.dirname(audio_path), wav_filename)
+    if preserve_pitch:
+        # Используем собственный STFT для сохранения тональности
+        processed = process_with_custom_stft_stretch(y, speed_factor, sr)
+    else:
+        # Простое изменение скорости через ресэмплинг
+        processed = process_with_resampling(y, speed_factor, sr)
     
-    try:
-        # Конвертируем через ffmpeg
-        cmd = [
-            'ffmpeg', '-i', audio_path,
-            '-acodec', 'pcm_s16le',
-            '-ar', '44100',
-            '-ac', '2',
-            '-y', wav_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            print(f"✅ MP3 конвертирован через ffmpeg: {wav_path}")
-            return wav_path
+    return processed, sr
+
+class MappedWav:
+    """
+    WAV/RF64 файл, отображенный в память. Заголовок разбирается вручную,
+    чанк данных открывается через np.memmap: каналы доступны как view без
+    копирования, а в float32 данные переводятся лениво - по блокам
+    """
+    # Коды форматов из fmt чанка
+    FORMAT_PCM = 0x0001
+    FORMAT_FLOAT = 0x0003
+    FORMAT_EXTENSIBLE = 0xFFFE
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+            if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+                raise ValueError(f"Не WAV файл: {path}")
+            file_size = os.fstat(f.fileno()).st_size
+            
+            fmt = None
+            ds64_data_size = None
+            data_offset = data_size = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'ds64':
+                    # RF64: настоящие 64-битные размеры лежат в ds64
+                    ds64_data_size = struct.unpack('<QQ', f.read(16))[1]
+                    f.seek(chunk_size - 16, os.SEEK_CUR)
+                elif chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                elif chunk_id == b'data':
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                        data_size = ds64_data_size
+                    break
+                else:
+                    f.seek(chunk_size, os.SEEK_CUR)
+                # Чанки выровнены по 2 байта
+                if chunk_size & 1:
+                    f.seek(1, os.SEEK_CUR)
+        
+        if fmt is None or data_offset is None:
+            raise ValueError(f"В WAV нет fmt или data чанка: {path}")
+        
+        format_tag, channels, sr, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+        if format_tag == self.FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            # Первые 2 байта GUID подформата - обычный код формата
+            format_tag = struct.unpack('<H', fmt[24:26])[0]
+        
+        if format_tag == self.FORMAT_PCM and bits in (8, 16, 24, 32):
+            dtype = {8: np.uint8, 16: np.dtype('<i2'), 24: np.uint8, 32: np.dtype('<i4')}[bits]
+        elif format_tag == self.FORMAT_FLOAT and bits in (32, 64):
+            dtype = np.dtype('<f4') if bits == 32 else np.dtype('<f8')
+        else:
+            raise ValueError(f"Неподдерживаемый формат WAV: tag={format_tag}, {bits} бит")
+        
+        # Размер 0 или 0xFFFFFFFF пишут потоковые кодеры - берем остаток файла
+        available = file_size - data_offset
+        if data_size in (0, 0xFFFFFFFF) or data_size > available:
+            data_size = available
+        
+        self.sr = int(sr)
+        self.channels = int(channels)
+        self.bit_depth = int(bits)
+        self.is_float = format_tag == self.FORMAT_FLOAT
+        self.n_samples = int(data_size // block_align) if block_align else 0
+        
+        shape = (self.n_samples, self.channels, 3) if bits == 24 else (self.n_samples, self.channels)
+        if self.n_samples > 0:
+            self.data = np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+        else:
+            self.data = np.zeros(shape, dtype=dtype)
+    
+    @property
+    def duration(self):
+        return self.n_samples / self.sr if self.sr else 0.0
+    
+    def channel(self, index):
+        """
+        Сырые отсчеты одного канала - strided view без копирования
+        """
+        return self.data[:, index]
+    
+    def read_block(self, start, stop, out=None):
+        """
+        Блок float32 (channels, stop - start), дополненный нулями за концом файла
+        """
+        block = out if out is not None else np.empty((self.channels, stop - start), dtype=np.float32)
+        available = max(0, min(stop, self.n_samples) - start)
+        block[:, available:] = 0.0
+        if available <= 0:
+            return block
+        
+        raw = self.data[start:start + available]
+        target = block[:, :available]
+        if self.bit_depth == 24:
+            # 3 байта little-endian -> старшие байты int32, масштаб как у 32 бит
+            padded = np.zeros(raw.shape[:2] + (4,), dtype=np.uint8)
+            padded[..., 1:] = raw
+            target[:] = padded.view('<i4')[..., 0].T
+            target *= 1.0 / 2147483648.0
+        elif self.bit_depth == 8:
+            target[:] = raw.T
+            target -= 128.0
+            target *= 1.0 / 128.0
         else:
-            print(f"⚠️ Ошибка ffmpeg: {result.stderr}")
-            raise Exception("Не удалось конвертировать MP3")
+            target[:] = raw.T
+            if not self.is_float:
+                target *= 1.0 / float(1 << (self.bit_depth - 1))
+        return block
+    
+    def to_float32(self, block_size=None):
+        """
+        Весь файл в float32 (channels, samples): единственная копия в памяти,
+        заполняемая поблочно
+        """
+        block_size = block_size or STREAM_BLOCK_SAMPLES
+        audio = np.empty((self.channels, self.n_samples), dtype=np.float32)
+        for start in range(0, self.n_samples, block_size):
+            stop = min(start + block_size, self.n_samples)
+            self.read_block(start, stop, out=audio[:, start:stop])
+        return audio
+    
+    def close(self):
+        self.data = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def load_audio_with_scipy(audio_path, with_engine=False):
+    """
+    Загрузка аудио файлов без librosa: декодер выбирается реестром движков
+    по расширению (WAV - через mmap, сжатые форматы - через ffmpeg или
+    soundfile). with_engine=True - вернуть также имя сработавшего движка
+    """
+    try:
+        # Проверяем расширение файла
+        _, ext = os.path.splitext(audio_path.lower())
+        return run_engine('decode', audio_path, extension=ext, with_engine=with_engine)
             
     except Exception as e:
-        print(f"⚠️ Ошибка конвертации через ffmpeg: {e}")
+        print(f"Ошибка загрузки аудио: {e}")
         raise
 
-def create_compatible_wav_for_rubberband(audio_data, sample_rate):
+def decode_wav_mmap(audio_path):
     """
-    Создает WAV файл в совместимом с Rubber Band формате (int16, 44.1kHz, stereo)
+    WAV читается через mmap и переводится в float32 (channels, samples)
+    поблочно - без промежуточной целочисленной копии в памяти
     """
-    import tempfile
-    from scipy.io.wavfile import write
+    with MappedWav(audio_path) as wav:
+        data = wav.to_float32()
+        sr = wav.sr
     
-    # Создаем временный файл
-    temp_fd, temp_path = tempfile.mkstemp(suffix='.wav')
-    os.close(temp_fd)
+    # Моно остается одномерным
+    if data.shape[0] == 1:
+        data = data[0]
+    
+    return data, sr
+
+def decode_audio_with_soundfile(audio_path):
+    """
+    Декодирование через libsndfile (FLAC, OGG, MP3 в новых версиях)
+    """
+    data, sr = sf.read(audio_path, dtype='float32', always_2d=True)
+    if data.shape[1] == 1:
+        return data[:, 0], sr
+    return np.ascontiguousarray(data.T), sr
+
+# Форматы, которые декодируются через ffmpeg (WAV читается напрямую через mmap)
+FFMPEG_DECODE_EXTENSIONS = {'.mp3', '.flac', '.m4a', '.aac'}
+
+# Размер чтения из stdout ffmpeg при декодировании, байт
+DECODE_CHUNK_BYTES = 1 << 20
+
+def probe_audio_stream(audio_path):
+    """
+    Параметры первого аудиопотока через ffprobe, без декодирования:
+    {'sr', 'channels', 'duration', 'codec', 'bit_depth'} или None
+    """
+    import subprocess
     
     try:
-        print(f"🔧 Входные данные: shape={audio_data.shape}, sr={sample_rate}")
-        
-        # Копируем данные для обработки
-        processed_audio = audio_data.copy()
-        
-        # Приводим к стандартной частоте дискретизации 44.1kHz
-        target_sr = 44100
-        if sample_rate != target_sr:
-            print(f"🔄 Ресэмплинг с {sample_rate}Hz на {target_sr}Hz")
-            # Ресэмплинг до 44.1kHz
-            from scipy import signal
-            processed_channels = []
-            for channel in range(processed_audio.shape[0]):
-                resampled = signal.resample(
-                    processed_audio[channel], 
-                    int(len(processed_audio[channel]) * target_sr / sample_rate)
-                )
-                processed_channels.append(resampled)
-            processed_audio = np.array(processed_channels)
-            sample_rate = target_sr
-        
-        print(f"🎵 После ресэмплинга: shape={processed_audio.shape}")
-        
-        # Проверяем, что данные не пустые
-        if processed_audio.size == 0:
-            raise ValueError("Аудио данные пустые после обработки")
-        
-        # Нормализуем и конвертируем в int16
-        processed_audio = np.clip(processed_audio, -1.0, 1.0)
-        
-        # Если стерео, транспонируем для правильного формата (samples, channels)
-        if processed_audio.ndim == 2:
-            audio_for_write = processed_audio.T
-            print(f"📊 Стерео данные: {audio_for_write.shape} (samples, channels)")
-        else:
-            audio_for_write = processed_audio
-            print(f"📊 Моно данные: {audio_for_write.shape}")
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+             '-show_entries', 'stream=sample_rate,channels,codec_name,bits_per_raw_sample,bits_per_sample,duration'
+             ':format=duration',
+             '-of', 'json', audio_path],
+            capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    
+    try:
+        info = json.loads(result.stdout)
+        stream = info['streams'][0]
+        duration = stream.get('duration') or info.get('format', {}).get('duration')
+        bit_depth = int(stream.get('bits_per_raw_sample') or stream.get('bits_per_sample') or 0)
+        return {
+            'sr': int(stream['sample_rate']),
+            'channels': int(stream['channels']),
+            'duration': float(duration) if duration not in (None, 'N/A') else None,
+            'codec': stream.get('codec_name'),
+            'bit_depth': bit_depth or None
+        }
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def decode_audio_with_ffmpeg(audio_path, sr=None, channels=None):
+    """
+    Декодирование любого поддерживаемого ffmpeg формата прямо в NumPy:
+    ffmpeg пишет float32 PCM в stdout, чанки разворачиваются из interleaved
+    в заранее выделенный буфер (channels, samples). По умолчанию сохраняются
+    исходные частота и число каналов. Моно возвращается одномерным
+    """
+    import subprocess
+    
+    info = probe_audio_stream(audio_path)
+    if info is None:
+        raise ValueError(f"ffprobe не смог прочитать файл: {audio_path}")
+    
+    target_sr = int(sr or info['sr'])
+    target_channels = int(channels or info['channels'])
+    
+    cmd = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+           '-i', audio_path, '-map', '0:a:0', '-f', 'f32le', '-acodec', 'pcm_f32le',
+           '-ar', str(target_sr), '-ac', str(target_channels), 'pipe:1']
+    
+    # Буфер по длительности из заголовка (с запасом); при нехватке - расширяется
+    expected = int((info['duration'] or 0) * target_sr) + target_sr
+    audio = np.empty((target_channels, expected), dtype=np.float32)
+    frame_bytes = 4 * target_channels
+    chunk = np.empty(max(DECODE_CHUNK_BYTES // frame_bytes, 1) * target_channels, dtype=np.float32)
+    chunk_bytes = memoryview(chunk).cast('B')
+    
+    position = 0
+    pending = 0
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            while True:
+                read = process.stdout.readinto(chunk_bytes[pending:])
+                if not read:
+                    break
+                pending += read
+                frames = pending // frame_bytes
+                if frames == 0:
+                    continue
+                
+                if position + frames > audio.shape[1]:
+                    grown = np.empty((target_channels, max(audio.shape[1] * 3 // 2, position + frames)),
+                                     dtype=np.float32)
+                    grown[:, :position] = audio[:, :position]
+                    audio = grown
+                audio[:, position:position + frames] = \
+                    chunk[:frames * target_channels].reshape(frames, target_channels).T
+                position += frames
+                
+                # Неполный кадр переносим в начало чанка
+                leftover = pending - frames * frame_bytes
+                if leftover:
+                    chunk_bytes[:leftover] = chunk_bytes[frames * frame_bytes:pending]
+                pending = leftover
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
         
-        # Конвертируем в int16
-        audio_int16 = (audio_for_write * 32767).astype(np.int16)
+        if returncode != 0:
+            stderr_file.seek(0)
+            error = stderr_file.read().decode('utf-8', 'replace').strip()
+            raise RuntimeError(f"ffmpeg не смог декодировать {audio_path}: {error}")
+    
+    if position == 0:
+        raise ValueError(f"ffmpeg не вернул аудио: {audio_path}")
+    
+    audio = audio[:, :position]
+    print(f"🎵 Декодировано через ffmpeg: {info['codec']}, {target_sr}Hz, "
+          f"{target_channels} канал(ов), {position} сэмплов")
+    if target_channels == 1:
+        return audio[0], target_sr
+    return audio, target_sr
+
+def decode_audio_to_wav(audio_path, wav_path=None):
+    """
+    Декодирование в WAV файл рядом с исходным (для Rubber Band CLI и
+    потокового рендеринга): ffmpeg пишет файл потоком, исходные частота и
+    число каналов сохраняются. Имя по умолчанию уникально: несколько
+    процессов пула могут декодировать один вход одновременно. Удаляет
+    файл вызывающий
+    """
+    import subprocess
+    
+    if wav_path is None:
+        base_name = os.path.splitext(os.path.basename(audio_path))[0]
+        wav_path = os.path.join(os.path.dirname(audio_path), f"{base_name}_{uuid.uuid4().hex}.wav")
+    
+    # RF64 автоматически, если результат не помещается в обычный WAV
+    cmd = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+           '-i', audio_path, '-map', '0:a:0', '-acodec', 'pcm_f32le',
+           '-rf64', 'auto', '-y', wav_path]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"⚠️ Ошибка ffmpeg: {result.stderr}")
+        raise RuntimeError(f"Не удалось декодировать {audio_path}")
+    
+    print(f"✅ Декодировано в WAV через ffmpeg: {wav_path}")
+    return wav_path
+
+def process_with_custom_stft_stretch(y, speed_factor, sr):
+    """
+    Собственная реализация STFT растяжения без librosa
+    """
+    try:
+        # Параметры STFT
+        n_fft = 2048
+        hop_length = n_fft // 4
         
-        print(f"💾 Записываем WAV: {audio_int16.shape}, dtype={audio_int16.dtype}")
+        # Прямое STFT сразу по всем каналам: (channels, bins, frames)
+        stft = custom_stft(y, n_fft, hop_length)
         
-        # Записываем WAV файл
-        write(temp_path, sample_rate, audio_int16)
+        # Растягиваем по времени сразу все каналы
+        stretched_stft = stretch_stft(stft, speed_factor, hop_length)
         
-        # Проверяем размер созданного файла
-        file_size = os.path.getsize(temp_path)
-        print(f"📁 Создан совместимый WAV: {sample_rate}Hz, int16, {'stereo' if audio_for_write.ndim == 2 else 'mono'}, размер: {file_size} байт")
+        # Обратное STFT по всем каналам
+        return custom_istft(stretched_stft, hop_length)
         
-        if file_size < 1000:  # Если файл меньше 1KB, вероятно что-то не так
-            print(f"⚠️ Подозрительно маленький файл: {file_size} байт")
+    except Exception as e:
+        print(f"Ошибка custom STFT: {e}")
+        # Fallback на простую интерполяцию
+        count_fallback('stretch', 'custom_stft_error')
+        return process_simple_stretch(y, speed_factor)
+
+def frame_signal(signal, n_fft, hop_length):
+    """
+    Нарезка сигнала (..., samples) на кадры (..., frames, n_fft) без копирования
+    """
+    frames = np.lib.stride_tricks.sliding_window_view(signal, n_fft, axis=-1)
+    return frames[..., ::hop_length, :]
+
+def overlap_add(frames, hop_length):
+    """
+    Векторизованное overlap-add кадров (..., frames, n_fft) в сигнал (..., samples)
+    """
+    n_frames, n_fft = frames.shape[-2:]
+    leading = frames.shape[:-2]
+    signal_length = (n_frames - 1) * hop_length + n_fft
+    output = np.zeros(leading + (signal_length,), dtype=frames.dtype)
+    
+    if n_fft % hop_length == 0:
+        # Кадр режется на n_fft / hop сегментов длиной hop: сегмент k всех
+        # кадров ложится непрерывной полосой со сдвигом k * hop
+        segments = frames.reshape(leading + (n_frames, n_fft // hop_length, hop_length))
+        for k in range(n_fft // hop_length):
+            start = k * hop_length
+            output[..., start:start + n_frames * hop_length] += \
+                segments[..., k, :].reshape(leading + (n_frames * hop_length,))
+    else:
+        indices = np.arange(n_frames)[:, np.newaxis] * hop_length + np.arange(n_fft)
+        flat_output = output.reshape(-1, signal_length)
+        flat_frames = frames.reshape(-1, n_frames * n_fft)
+        for row in range(flat_output.shape[0]):
+            np.add.at(flat_output[row], indices.ravel(), flat_frames[row])
+    
+    return output
+
+def window_sum_square(window, n_frames, hop_length):
+    """
+    Сумма квадратов окон для overlap-add без материализации всех кадров
+    """
+    n_fft = len(window)
+    window_sq = window * window
+    window_sum = np.zeros((n_frames - 1) * hop_length + n_fft, dtype=window_sq.dtype)
+    if n_fft % hop_length == 0:
+        for k in range(n_fft // hop_length):
+            start = k * hop_length
+            window_sum[start:start + n_frames * hop_length] += \
+                np.tile(window_sq[start:start + hop_length], n_frames)
+    else:
+        for i in range(n_frames):
+            window_sum[i * hop_length:i * hop_length + n_fft] += window_sq
+    return window_sum
+
+def custom_stft(signal, n_fft, hop_length):
+    """
+    Собственная реализация STFT.
+    Принимает сигнал (samples) или (channels, samples) и считает все кадры
+    одним многокадровым FFT; результат (bins, frames) или (channels, bins, frames)
+    """
+    # Создаем окно Хэннинга; весь расчет идет в float32 / complex64
+    window = np.hanning(n_fft).astype(np.float32)
+    
+    signal = np.asarray(signal, dtype=np.float32)
+    if signal.shape[-1] < n_fft:
+        return np.zeros(signal.shape[:-1] + (n_fft // 2 + 1, 0), dtype=np.complex64)
+    
+    # Кадры как strided view; окно и многокадровое FFT по всем каналам
+    # блоками по STFT_BLOCK_FRAMES кадров
+    frames = frame_signal(signal, n_fft, hop_length)
+    n_frames = frames.shape[-2]
+    stft_matrix = np.empty(frames.shape[:-2] + (n_frames, n_fft // 2 + 1), dtype=np.complex64)
+    for start in range(0, n_frames, STFT_BLOCK_FRAMES):
+        stop = start + STFT_BLOCK_FRAMES
+        stft_matrix[..., start:stop, :] = scipy_fft.rfft(
+            frames[..., start:stop, :] * window, axis=-1, workers=FFT_WORKERS
+        )
+    
+    return np.swapaxes(stft_matrix, -1, -2)
+
+def custom_istft(stft_matrix, hop_length):
+    """
+    Улучшенная реализация обратного STFT с правильной нормализацией.
+    Принимает (bins, frames) или (channels, bins, frames)
+    """
+    n_fft = (stft_matrix.shape[-2] - 1) * 2
+    
+    # Создаем окно
+    window = np.hanning(n_fft).astype(np.float32)
+    
+    # Обратное FFT (complex64 -> float32), окно и overlap-add блоками по
+    # STFT_BLOCK_FRAMES кадров; блок добавляется в выход со своим смещением
+    stft_matrix = np.asarray(stft_matrix, dtype=np.complex64)
+    n_frames = stft_matrix.shape[-1]
+    reconstructed = np.zeros(stft_matrix.shape[:-2] + ((n_frames - 1) * hop_length + n_fft,),
+                             dtype=np.float32)
+    for start in range(0, n_frames, STFT_BLOCK_FRAMES):
+        frames = scipy_fft.irfft(np.swapaxes(stft_matrix[..., start:start + STFT_BLOCK_FRAMES], -1, -2),
+                                 n_fft, axis=-1, workers=FFT_WORKERS)
+        frames *= window
+        block = overlap_add(frames, hop_length)
+        offset = start * hop_length
+        reconstructed[..., offset:offset + block.shape[-1]] += block
+    
+    # Сумма квадратов окон одинакова для всех каналов
+    window_sum = window_sum_square(window, n_frames, hop_length)
+    
+    # Нормализуем по сумме окон для избежания искажений (на месте, без копий)
+    reconstructed *= inverse_window_sum(window_sum, window, hop_length)
+    
+    return reconstructed
+
+def inverse_window_sum(window_sum, window, hop_length):
+    """
+    Обратная сумма окон float32. На краях сигнала окна почти не
+    перекрываются, и деление на крошечную сумму раздувает несогласованные
+    после растяжения кадры в пики, которые потом включали мягкое ограничение
+    всего трека. Поэтому сумма ограничивается снизу долей установившегося
+    значения: края слегка затухают вместо выбросов
+    """
+    floor = 0.1 * float(np.dot(window, window)) / hop_length
+    return (1.0 / np.maximum(window_sum, floor)).astype(np.float32)
+
+def process_with_stft_stretch(y, speed_factor, sr):
+    """
+    Растяжение времени с сохранением тональности через STFT
+    """
+    try:
+        # Параметры STFT
+        n_fft = 2048
+        hop_length = n_fft // 4
+        
+        # Прямое STFT сразу по всем каналам: (channels, bins, frames)
+        stft = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+        
+        # Растягиваем по времени
+        stretched_stft = stretch_stft(stft, speed_factor, hop_length)
         
-        return temp_path
+        # Обратное STFT
+        return librosa.istft(stretched_stft, hop_length=hop_length)
         
     except Exception as e:
-        print(f"⚠️ Ошибка создания совместимого WAV: {e}")
-        import traceback
-        traceback.print_exc()
-        # Удаляем файл при ошибке
+        print(f"Ошибка STFT: {e}")
+        # Fallback на простую интерполяцию
+        return process_simple_stretch(y, speed_factor)
+
+def stretch_stft(stft, speed_factor, hop_length=None):
+    """
+    Растяжение STFT матрицы фазовым вокодером.
+    Принимает (bins, frames) или (channels, bins, frames): амплитуды и фазы
+    считаются один раз, интерполяция идет индексированием массивов,
+    а фаза накапливается кумулятивной суммой приращений
+    """
+    n_bins, original_frames = stft.shape[-2:]
+    n_fft = (n_bins - 1) * 2
+    if hop_length is None:
+        hop_length = n_fft // 4
+    
+    new_frames = int(original_frames / speed_factor)
+    if new_frames <= 0 or original_frames == 0:
+        return np.zeros(stft.shape[:-1] + (max(new_frames, 0),), dtype=np.complex64)
+    
+    # Позиции выходных кадров во входной последовательности
+    time_steps = np.arange(new_frames) * speed_factor
+    frame_idx = np.minimum(time_steps.astype(np.int64), original_frames - 1)
+    next_idx = np.minimum(frame_idx + 1, original_frames - 1)
+    fraction = (time_steps - frame_idx).astype(np.float32)
+    
+    stretched, _ = phase_vocoder(
+        np.abs(stft), np.angle(stft), frame_idx, next_idx, fraction, hop_length
+    )
+    return stretched
+
+def phase_vocoder(magnitude, phase, frame_idx, next_idx, fraction, hop_length, initial_phase=None):
+    """
+    Ядро фазового вокодера: синтез выходных кадров из амплитуд и фаз входных.
+    initial_phase - накопленная фаза первого выходного кадра (для продолжения
+    между блоками); возвращает также фазу для следующего кадра
+    """
+    n_bins = magnitude.shape[-2]
+    fraction = np.asarray(fraction, dtype=np.float32)
+    
+    # Интерполяция амплитуд между соседними кадрами (float32, на месте)
+    interp_amp = magnitude[..., frame_idx] * (1 - fraction)
+    interp_amp += magnitude[..., next_idx] * fraction
+    
+    # Ожидаемый набег фазы за один hop для каждого бина. На выход влияет
+    # только фаза по модулю 2pi, поэтому набег тоже берется по модулю 2pi -
+    # так приращения остаются малыми и точны в float32
+    phase_advance = np.mod(np.linspace(0, np.pi * hop_length, n_bins), 2.0 * np.pi)
+    phase_advance = phase_advance.astype(np.float32)[:, np.newaxis]
+    
+    # Отклонение от ожидаемого набега, приведенное к [-pi, pi]
+    dphase = phase[..., next_idx] - phase[..., frame_idx]
+    dphase -= phase_advance
+    dphase -= np.float32(2.0 * np.pi) * np.round(dphase / np.float32(2.0 * np.pi))
+    dphase += phase_advance
+    
+    # Фаза выходного кадра i = фаза первого кадра + сумма приращений до i.
+    # Сумма по тысячам кадров накапливается в float64, иначе теряется точность
+    phase_acc = np.empty(dphase.shape, dtype=np.float64)
+    if initial_phase is None:
+        phase_acc[..., 0] = phase[..., frame_idx[0]]
+    else:
+        phase_acc[..., 0] = initial_phase
+    if len(frame_idx) > 1:
+        np.cumsum(dphase[..., :-1], axis=-1, dtype=np.float64, out=phase_acc[..., 1:])
+        phase_acc[..., 1:] += phase_acc[..., :1]
+    
+    next_phase = np.mod(phase_acc[..., -1] + dphase[..., -1], 2.0 * np.pi)
+    del dphase
+    
+    # Приводим фазу к [0, 2pi) и собираем complex64 спектр
+    np.mod(phase_acc, 2.0 * np.pi, out=phase_acc)
+    phase_out = phase_acc.astype(np.float32)
+    del phase_acc
+    stretched = np.empty(phase_out.shape, dtype=np.complex64)
+    stretched.real = np.cos(phase_out)
+    stretched.real *= interp_amp
+    np.sin(phase_out, out=phase_out)
+    phase_out *= interp_amp
+    stretched.imag = phase_out
+    return stretched, next_phase
+
+# Предел up и down рационального приближения скорости для полифазного
+# ресэмплинга. Длина фильтра ~20 * max(up, down): при 200 это не больше 4001
+# отвода. Скорости с двумя знаками от 0.1 до 2 представляются точно,
+# погрешность произвольной скорости - не больше 0.3%
+VARISPEED_MAX_RATE = int(os.environ.get('VARISPEED_MAX_RATE', '200'))
+
+def varispeed_ratio(speed_factor):
+    """
+    Скорость как рациональная дробь: ресэмплинг в up/down раз,
+    где down / up приближает speed_factor, а up и down не больше
+    VARISPEED_MAX_RATE
+    """
+    # Для ускорения числитель ~ speed * знаменатель: ограничиваем оба
+    max_denominator = max(1, int(VARISPEED_MAX_RATE / max(speed_factor, 1.0)))
+    ratio = Fraction(speed_factor).limit_denominator(max_denominator)
+    if ratio <= 0:
+        ratio = Fraction(1, max_denominator)
+    return ratio.denominator, ratio.numerator
+
+@lru_cache(maxsize=32)
+def design_resample_filter(up, down):
+    """
+    Антиалиасинговый FIR фильтр для полифазного ресэмплинга up/down
+    (те же параметры, что по умолчанию у scipy.signal.resample_poly).
+    Фильтр кэшируется: при повторе скорости не пересчитывается
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    taps = signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    taps.setflags(write=False)
+    return taps
+
+def process_with_resampling(y, speed_factor, sr):
+    """
+    Изменение скорости без сохранения тональности: полифазный ресэмплинг
+    с ограничением полосы, сразу по всем каналам
+    """
+    try:
+        up, down = varispeed_ratio(speed_factor)
+        if up == down:
+            return np.array(y, dtype=np.float32)
+        
+        taps = design_resample_filter(up, down)
+        processed = signal.resample_poly(
+            np.asarray(y, dtype=np.float32), up, down, axis=-1, window=taps
+        )
+        return processed.astype(np.float32, copy=False)
+        
+    except Exception as e:
+        print(f"Ошибка ресэмплинга: {e}")
+        return process_simple_stretch(y, speed_factor)
+
+class StreamingResampler:
+    """
+    Потоковый полифазный ресэмплинг в up/down раз с сохранением состояния
+    между блоками. Дает тот же результат, что scipy.signal.resample_poly по
+    всему сигналу, но память ограничена размером блока: хранится только
+    история входа, нужная фильтру. Выходные блоки выровнены по периоду
+    полифазной схемы (up выходов на down входов), поэтому каждый блок
+    считается одним вызовом upfirdn без пересчета фазы
+    """
+    def __init__(self, up, down, channels):
+        self.up = int(up)
+        self.down = int(down)
+        taps = design_resample_filter(self.up, self.down)
+        self.half_len = (len(taps) - 1) // 2
+        
+        # История входа до первого выходного отсчета; нули слева от начала сигнала
+        self.history = -(-self.half_len // self.up)
+        # Нули перед фильтром, чтобы смещение выхода upfirdn было целым
+        pre_pad = -(self.half_len + self.history * self.up) % self.down
+        self.offset = (self.half_len + pre_pad + self.history * self.up) // self.down
+        self.taps = np.concatenate([np.zeros(pre_pad), taps * self.up]).astype(np.float32)
+        
+        self._buffer = np.zeros((channels, self.history), dtype=np.float32)
+        self._buffer_start = -self.history  # индекс входа для _buffer[:, 0]
+        self._received = 0
+        self._produced = 0
+    
+    def _last_input(self, out_index):
+        # Индекс последнего входного отсчета, нужного выходу out_index
+        return (out_index * self.down + self.half_len) // self.up
+    
+    def _emit(self, out_stop):
+        count = out_stop - self._produced
+        if count <= 0:
+            return np.zeros((self._buffer.shape[0], 0), dtype=np.float32)
+        
+        start = self._produced * self.down // self.up - self.history
+        stop = self._last_input(out_stop - 1) + 1
+        segment = self._buffer[:, start - self._buffer_start:stop - self._buffer_start]
+        output = signal.upfirdn(self.taps, segment, self.up, self.down, axis=-1)
+        output = output[:, self.offset:self.offset + count].astype(np.float32, copy=False)
+        
+        self._produced = out_stop
+        # Отбрасываем вход, который следующим выходам уже не нужен
+        next_start = out_stop * self.down // self.up - self.history
+        drop = max(0, next_start - self._buffer_start)
+        self._buffer = self._buffer[:, drop:]
+        self._buffer_start += drop
+        return output
+    
+    def process(self, block):
+        """
+        Принимает блок (channels, samples), возвращает все выходные отсчеты,
+        которые уже можно посчитать
+        """
+        self._buffer = np.concatenate([self._buffer, np.asarray(block, dtype=np.float32)], axis=1)
+        self._received += block.shape[1]
+        
+        # Целое число периодов, для которых весь нужный вход уже получен
+        periods = 0
+        available = (self._received * self.up - self.half_len) // self.down - self._produced
+        if available > 0:
+            periods = available // self.up
+        out_stop = self._produced + periods * self.up
+        while out_stop > self._produced and self._last_input(out_stop - 1) >= self._received:
+            out_stop -= self.up
+        return self._emit(out_stop)
+    
+    def flush(self):
+        """
+        Досчитывает хвост: вход за концом сигнала считается нулевым
+        """
+        total = -(-self._received * self.up // self.down)
+        needed = self._last_input(total - 1) + 1 - (self._buffer_start + self._buffer.shape[1])
+        if needed > 0:
+            self._buffer = np.concatenate(
+                [self._buffer, np.zeros((self._buffer.shape[0], needed), dtype=np.float32)], axis=1
+            )
+        return self._emit(total)
+
+def resample_to_rate(y, sr, target_sr):
+    """
+    Смена частоты дискретизации полифазным ресэмплингом (блоками, без FFT
+    по всему сигналу). Возвращает float32 того же вида, что вход
+    """
+    if int(sr) == int(target_sr):
+        return y
+    ratio = Fraction(int(target_sr), int(sr))
+    audio = np.atleast_2d(y)
+    resampler = StreamingResampler(ratio.numerator, ratio.denominator, audio.shape[0])
+    
+    blocks = []
+    for start in range(0, audio.shape[1], STREAM_BLOCK_SAMPLES):
+        blocks.append(resampler.process(audio[:, start:start + STREAM_BLOCK_SAMPLES]))
+    blocks.append(resampler.flush())
+    resampled = np.concatenate(blocks, axis=1)
+    return resampled[0] if np.ndim(y) == 1 else resampled
+
+def process_simple_stretch(y, speed_factor):
+    """
+    Простое растяжение без библиотек
+    """
+    original_length = y.shape[-1]
+    new_length = int(original_length / speed_factor)
+    processed = np.empty((y.shape[0], new_length), dtype=np.float32)
+    
+    # Линейная интерполяция
+    old_indices = np.arange(original_length)
+    new_indices = np.linspace(0, original_length - 1, new_length)
+    
+    for channel in range(y.shape[0]):
+        processed[channel] = np.interp(new_indices, old_indices, y[channel])
+    
+    return processed
+
+def parse_target_lufs(value):
+    """
+    Целевая громкость из строки: LUFS от -70 до 0 или None для пустой строки.
+    При ошибке кидает ValueError
+    """
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        target_lufs = float(value)
+    except ValueError:
+        raise ValueError(f'Недопустимая целевая громкость: {value}')
+    if not -70.0 <= target_lufs <= 0.0:
+        raise ValueError(f'Целевая громкость должна быть от -70 до 0 LUFS: {target_lufs}')
+    return target_lufs
+
+# Целевая громкость по умолчанию в LUFS (например -14); пусто - RMS нормализация.
+# Проверяется при запуске: ошибка в настройке не должна ломать каждый запрос
+NORMALIZATION_TARGET_LUFS = parse_target_lufs(os.environ.get('NORMALIZATION_TARGET_LUFS', ''))
+
+def normalize_audio(audio, sr=None, target_lufs=None, block_size=None):
+    """
+    Нормализация аудио с предотвращением клиппинга.
+    По умолчанию - RMS нормализация до уровня 0.2, с target_lufs (и sr) -
+    до заданной интегральной громкости по BS.1770. Статистика собирается
+    одним проходом по блокам, усиление и мягкое ограничение пиков через
+    tanh применяются на месте вторым проходом
+    """
+    # Работаем в float32 и на месте; копия только если буфер нельзя менять
+    audio = np.asarray(audio, dtype=np.float32)
+    if not audio.flags.writeable:
+        audio = audio.copy()
+    
+    block_size = block_size or STREAM_BLOCK_SAMPLES
+    blocks = np.atleast_2d(audio)
+    
+    stats = AudioStats(sr if target_lufs is not None else None)
+    for start in range(0, blocks.shape[1], block_size):
+        stats.update(blocks[:, start:start + block_size])
+    
+    gain, soft_limit = stats.normalization_gain(target_lufs=target_lufs)
+    for start in range(0, blocks.shape[1], block_size):
+        apply_normalization_block(blocks[:, start:start + block_size], gain, soft_limit)
+    return audio
+
+def quantize_pcm16(block):
+    """
+    Блок float32 (channels, samples) -> interleaved little-endian int16 байты.
+    Клиппинг и округление идут во временном буфере размером с блок
+    """
+    scratch = np.clip(np.atleast_2d(block).T, -1.0, 1.0)
+    scratch *= 32767.0
+    np.rint(scratch, out=scratch)
+    return scratch.astype('<i2').tobytes()
+
+class PcmWavWriter:
+    """
+    Запись 16-bit PCM WAV блоками (channels, samples) прямо в файл.
+    В заголовке резервируется JUNK чанк под ds64: если данные не помещаются
+    в 32-битные размеры RIFF (> 4 ГБ), при закрытии заголовок переписывается
+    на месте в RF64
+    """
+    HEADER_SIZE = 12 + 36 + 24 + 8
+    
+    def __init__(self, path, sr, channels):
+        self.path = path
+        self.sr = int(sr)
+        self.channels = int(channels)
+        self.data_bytes = 0
+        self._file = open(path, 'wb')
+        self._file.write(self._header(rf64=False))
+    
+    def _header(self, rf64):
+        block_align = self.channels * 2
+        riff_size = self.HEADER_SIZE - 8 + self.data_bytes
+        if rf64:
+            head = b'RF64' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE'
+            # ds64: размер RIFF, размер данных, число сэмплов, пустая таблица
+            reserve = b'ds64' + struct.pack('<IQQQI', 28, riff_size, self.data_bytes,
+                                             self.data_bytes // block_align, 0)
+            data_size = 0xFFFFFFFF
+        else:
+            head = b'RIFF' + struct.pack('<I', riff_size & 0xFFFFFFFF) + b'WAVE'
+            reserve = b'JUNK' + struct.pack('<I', 28) + bytes(28)
+            data_size = self.data_bytes & 0xFFFFFFFF
+        fmt = b'fmt ' + struct.pack('<IHHIIHH', 16, 1, self.channels, self.sr,
+                                    self.sr * block_align, block_align, 16)
+        return head + reserve + fmt + b'data' + struct.pack('<I', data_size)
+    
+    def write(self, block):
+        pcm = quantize_pcm16(block)
+        self._file.write(pcm)
+        self.data_bytes += len(pcm)
+    
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._file.write(self._header(rf64=self.HEADER_SIZE - 8 + self.data_bytes > 0xFFFFFFFF))
+        self._file.close()
+    
+    def abort(self):
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class Mp3PipeWriter:
+    """
+    Кодирование MP3 на лету: блоки квантуются в 16-bit PCM и пишутся в stdin
+    ffmpeg (libmp3lame), который кодирует параллельно с рендерингом.
+    Промежуточный WAV на диск не пишется
+    """
+    def __init__(self, path, sr, channels):
+        import subprocess
+        self.path = path
+        self._stderr = tempfile.TemporaryFile()
+        cmd = [
+            'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(int(sr)), '-ac', str(int(channels)), '-i', 'pipe:0',
+            '-codec:a', 'libmp3lame',
+            '-b:a', '320k',  # Высокий битрейт
+            '-q:a', '0',     # Лучшее качество
+            '-y', path
+        ]
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self._stderr)
+    
+    def write(self, block):
         try:
-            os.unlink(temp_path)
-        except:
+            self._process.stdin.write(quantize_pcm16(block))
+        except BrokenPipeError:
+            self.close()
+            raise
+    
+    def close(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
             pass
+        returncode = process.wait()
+        self._stderr.seek(0)
+        error = self._stderr.read().decode('utf-8', 'replace').strip()
+        self._stderr.close()
+        if returncode != 0:
+            print(f"⚠️ Ошибка ffmpeg: {error}")
+            raise RuntimeError("Не удалось закодировать MP3")
+    
+    def abort(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        process.kill()
+        process.wait()
+        self._stderr.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class SoundFileWriter:
+    """
+    Блочная запись через libsndfile (запасной MP3 кодер, если нет ffmpeg)
+    """
+    def __init__(self, path, sr, channels, format, subtype=None):
+        self.path = path
+        self._file = sf.SoundFile(path, 'w', samplerate=int(sr), channels=int(channels),
+                                  format=format, subtype=subtype)
+    
+    def write(self, block):
+        self._file.write(np.atleast_2d(block).T)
+    
+    def close(self):
+        self._file.close()
+    
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def open_audio_writer(output_path, sr, channels, output_format='wav'):
+    """
+    Блочный writer для выходного формата: WAV/RF64 в файл или MP3 через ffmpeg
+    """
+    if output_format.lower() == 'mp3':
+        return run_engine('encode_mp3', output_path, sr, channels)
+    return PcmWavWriter(output_path, sr, channels)
+
+def write_audio_blocks(output_path, processed_audio, sr, output_format='wav', block_size=None):
+    """
+    Запись массива (channels, samples) блоками через open_audio_writer
+    """
+    block_size = block_size or STREAM_BLOCK_SAMPLES
+    audio = np.atleast_2d(processed_audio)
+    with open_audio_writer(output_path, sr, audio.shape[0], output_format) as writer:
+        for start in range(0, audio.shape[1], block_size):
+            writer.write(audio[:, start:start + block_size])
+    return output_path
+
+def save_audio_in_format(output_path, processed_audio, sr, output_format='wav'):
+    """
+    Сохранение аудио в указанном формате (WAV или MP3)
+    """
+    try:
+        if output_format.lower() == 'mp3':
+            # Сохраняем в MP3
+            return save_as_mp3(output_path, processed_audio, sr)
+        else:
+            # Сохраняем в WAV (по умолчанию)
+            return save_as_wav(output_path, processed_audio, sr)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения в формате {output_format}: {e}")
+        raise
+
+def save_as_wav(output_path, processed_audio, sr):
+    """
+    Сохранение аудио в формате WAV (RF64 для выходов больше 4 ГБ)
+    """
+    try:
+        write_audio_blocks(output_path, processed_audio, sr, 'wav')
+        print(f"✅ WAV файл сохранен: {output_path}")
+        return output_path
+    except Exception as e:
+        print(f"❌ Ошибка сохранения WAV: {e}")
+        raise
+
+def save_as_mp3(output_path, processed_audio, sr):
+    """
+    Сохранение аудио в формате MP3: PCM кодируется через stdin ffmpeg,
+    без временного WAV файла
+    """
+    try:
+        write_audio_blocks(output_path, processed_audio, sr, 'mp3')
+        print(f"✅ MP3 файл создан: {output_path}")
+        return output_path
+    except Exception as e:
+        print(f"❌ Ошибка сохранения MP3: {e}")
         raise
 
-def process_audio_with_librosa(audio_path, speed_factor, preserve_pitch=True):
+# ---------------------------------------------------------------------------
+# Потоковый рендеринг длинных треков
+#
+# Вход читается из WAV через mmap, растягивается блоками STFT кадров с
+# переносом накопленной фазы и хвоста overlap-add между блоками, а результат
+# пишется блоками. Пиковая память определяется размером блока, а не длиной
+# трека. Статистика для нормализации собирается во время рендеринга, поэтому
+# громкость совпадает с обычным путем (normalize_audio).
+# ---------------------------------------------------------------------------
+
+# Треки длиннее этого порога (в секундах) рендерятся потоково
+STREAMING_THRESHOLD_SECONDS = float(os.environ.get('STREAMING_THRESHOLD_SECONDS', 600))
+# Количество выходных STFT кадров в одном блоке
+STREAM_BLOCK_FRAMES = int(os.environ.get('STREAM_BLOCK_FRAMES', 512))
+# Количество сэмплов в блоке при чтении/записи PCM
+STREAM_BLOCK_SAMPLES = 1 << 18
+
+def probe_audio_duration(audio_path):
+    """
+    Длительность файла по заголовку, без декодирования (None, если неизвестна)
+    """
+    if audio_path.lower().endswith('.wav'):
+        try:
+            with MappedWav(audio_path) as wav:
+                return wav.duration
+        except Exception:
+            pass
+    
+    if HAS_SOUNDFILE:
+        try:
+            info = sf.info(audio_path)
+            if info.samplerate > 0 and info.frames > 0:
+                return info.frames / info.samplerate
+        except Exception:
+            pass
+    
+    info = probe_audio_stream(audio_path)
+    return info['duration'] if info is not None else None
+
+def open_wav_block_source(wav_path):
+    """
+    Открывает WAV через mmap. Возвращает (read_block, n_samples, channels, sr),
+    где read_block(start, stop) отдает float32 (channels, stop - start),
+    дополняя нулями за концом файла
+    """
+    wav = MappedWav(wav_path)
+    return wav.read_block, wav.n_samples, wav.channels, wav.sr
+
+def stream_stretch_blocks(read_block, n_samples, speed_factor, n_fft=2048, hop_length=512,
+                          block_frames=STREAM_BLOCK_FRAMES):
+    """
+    Потоковое растяжение фазовым вокодером с сохранением тональности.
+    Дает тот же результат, что process_with_custom_stft_stretch, но отдает
+    выход блоками float32 (channels, samples)
+    """
+    window = np.hanning(n_fft).astype(np.float32)
+    n_frames = (n_samples - n_fft) // hop_length + 1
+    if n_frames <= 0:
+        return
+    new_frames = int(n_frames / speed_factor)
+    
+    phase_carry = None
+    ola_tail = None
+    wsum_tail = None
+    
+    for out_start in range(0, new_frames, block_frames):
+        out_stop = min(out_start + block_frames, new_frames)
+        
+        # Позиции выходных кадров во входной последовательности
+        time_steps = np.arange(out_start, out_stop) * speed_factor
+        frame_idx = np.minimum(time_steps.astype(np.int64), n_frames - 1)
+        next_idx = np.minimum(frame_idx + 1, n_frames - 1)
+        fraction = time_steps - frame_idx
+        
+        # STFT только тех входных кадров, которые нужны этому блоку
+        first, last = frame_idx[0], next_idx[-1]
+        segment = read_block(first * hop_length, last * hop_length + n_fft)
+        stft = custom_stft(segment, n_fft, hop_length)
+        
+        stretched, phase_carry = phase_vocoder(
+            np.abs(stft), np.angle(stft), frame_idx - first, next_idx - first,
+            fraction, hop_length, initial_phase=phase_carry
+        )
+        del stft
+        
+        # Обратное STFT блока и overlap-add с хвостом предыдущего блока
+        frames = scipy_fft.irfft(np.swapaxes(stretched, -1, -2), n_fft, axis=-1, workers=FFT_WORKERS)
+        frames *= window
+        block = overlap_add(frames, hop_length)
+        wsum = window_sum_square(window, out_stop - out_start, hop_length)
+        del frames, stretched
+        
+        if ola_tail is not None:
+            block[:, :ola_tail.shape[1]] += ola_tail
+            wsum[:wsum_tail.shape[0]] += wsum_tail
+        
+        # Сэмплы до начала следующего кадра уже окончательные
+        ready = (out_stop - out_start) * hop_length
+        ola_tail, wsum_tail = block[:, ready:], wsum[ready:]
+        
+        output = block[:, :ready]
+        output *= inverse_window_sum(wsum[:ready], window, hop_length)
+        yield output
+    
+    if ola_tail is not None:
+        ola_tail *= inverse_window_sum(wsum_tail, window, hop_length)
+        yield ola_tail
+
+def stream_resample_blocks(read_block, n_samples, speed_factor, block_size=STREAM_BLOCK_SAMPLES):
+    """
+    Потоковое изменение скорости полифазным ресэмплингом
+    (тот же результат, что process_with_resampling)
+    """
+    up, down = varispeed_ratio(speed_factor)
+    resampler = None
+    
+    for start in range(0, n_samples, block_size):
+        block = read_block(start, min(start + block_size, n_samples))
+        if resampler is None:
+            resampler = StreamingResampler(up, down, block.shape[0])
+        output = resampler.process(block)
+        if output.shape[1]:
+            yield output
+    
+    if resampler is not None:
+        output = resampler.flush()
+        if output.shape[1]:
+            yield output
+
+@lru_cache(maxsize=8)
+def k_weighting_sos(sr):
+    """
+    K-взвешивающий фильтр BS.1770 для частоты sr: high-shelf и high-pass
+    биквады (коэффициенты пересчитываются из аналоговых прототипов, при
+    48 кГц совпадают с табличными)
+    """
+    # High-shelf (моделирует акустику головы)
+    k = np.tan(np.pi * 1681.974450955533 / sr)
+    q = 0.7071752369554196
+    vh = 10.0 ** (3.999843853973347 / 20.0)
+    vb = vh ** 0.4996667741545416
+    a0 = 1.0 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+    
+    # High-pass (RLB)
+    k = np.tan(np.pi * 38.13547087602444 / sr)
+    q = 0.5003270373238773
+    a0 = 1.0 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0]
+    
+    sos = np.array([shelf, highpass])
+    sos.setflags(write=False)
+    return sos
+
+class LoudnessMeter:
+    """
+    Интегральная громкость (LUFS) по BS.1770 поблочно: K-взвешивание с
+    сохранением состояния фильтров между блоками, средние квадраты по шагам
+    100 мс; при подсчете из них собираются 400 мс блоки с перекрытием 75%,
+    абсолютный (-70 LUFS) и относительный (-10 LU) гейты
+    """
+    def __init__(self, sr, channels):
+        self.sos = k_weighting_sos(int(sr)).copy()  # sosfilt требует изменяемый массив
+        self.step = max(int(round(sr * 0.1)), 1)
+        self._zi = np.zeros((self.sos.shape[0], channels, 2))
+        self._steps = []
+        self._partial = np.zeros(channels)
+        self._partial_count = 0
+    
+    def update(self, block):
+        filtered, self._zi = signal.sosfilt(self.sos, block, axis=-1, zi=self._zi)
+        position = 0
+        
+        # Дополняем незаконченный шаг предыдущего блока
+        if self._partial_count:
+            take = min(self.step - self._partial_count, filtered.shape[1])
+            chunk = filtered[:, :take]
+            self._partial += np.einsum('cs,cs->c', chunk, chunk)
+            self._partial_count += take
+            position = take
+            if self._partial_count == self.step:
+                self._steps.append(self._partial[:, np.newaxis] / self.step)
+                self._partial = np.zeros_like(self._partial)
+                self._partial_count = 0
+        
+        full = (filtered.shape[1] - position) // self.step
+        if full:
+            steps = filtered[:, position:position + full * self.step].reshape(filtered.shape[0], full, self.step)
+            self._steps.append(np.einsum('cns,cns->cn', steps, steps) / self.step)
+            position += full * self.step
+        
+        rest = filtered[:, position:]
+        if rest.shape[1]:
+            self._partial += np.einsum('cs,cs->c', rest, rest)
+            self._partial_count += rest.shape[1]
+    
+    def integrated(self):
+        """
+        Интегральная громкость в LUFS или None для тишины / пустого сигнала
+        """
+        if not self._steps:
+            if not self._partial_count:
+                return None
+            # Сигнал короче одного шага - считаем его одним блоком
+            powers = self._partial / self._partial_count
+            blocks = powers.sum()[np.newaxis]
+        else:
+            steps = np.concatenate(self._steps, axis=1)
+            if steps.shape[1] < 4:
+                blocks = steps.mean(axis=1).sum()[np.newaxis]
+            else:
+                # Блок 400 мс = 4 последовательных шага по 100 мс
+                cumulative = np.concatenate([np.zeros((steps.shape[0], 1)), np.cumsum(steps, axis=1)], axis=1)
+                blocks = ((cumulative[:, 4:] - cumulative[:, :-4]) / 4.0).sum(axis=0)
+        
+        with np.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10.0 * np.log10(blocks)
+        gated = blocks[block_loudness > -70.0]
+        if gated.size == 0:
+            return None
+        relative_gate = -0.691 + 10.0 * np.log10(gated.mean()) - 10.0
+        gated = blocks[block_loudness > max(relative_gate, -70.0)]
+        return float(-0.691 + 10.0 * np.log10(gated.mean()))
+
+class AudioStats:
+    """
+    Накопитель статистики для нормализации (RMS и пик) по блокам.
+    Если задана частота sr, попутно измеряется громкость в LUFS
+    """
+    def __init__(self, sr=None):
+        self.sum_squares = 0.0
+        self.count = 0
+        self.peak = 0.0
+        self.sr = sr
+        self.loudness = None
+    
+    def update(self, block):
+        # Скалярное произведение и min/max не создают временных массивов
+        block = np.atleast_2d(block)
+        flat = block.reshape(-1)
+        self.sum_squares += float(np.dot(flat, flat))
+        self.count += flat.size
+        if flat.size:
+            self.peak = max(self.peak, float(flat.max()), -float(flat.min()))
+        
+        if self.sr:
+            if self.loudness is None:
+                self.loudness = LoudnessMeter(self.sr, block.shape[0])
+            self.loudness.update(block)
+    
+    def normalization_gain(self, target_rms=0.2, target_lufs=None):
+        """
+        Усиление и необходимость мягкого ограничения, как в normalize_audio
+        """
+        if target_lufs is not None and self.loudness is not None:
+            integrated = self.loudness.integrated()
+            gain = 10.0 ** ((target_lufs - integrated) / 20.0) if integrated is not None else 1.0
+            if integrated is not None:
+                print(f"🔊 Громкость {integrated:.1f} LUFS, цель {target_lufs:.1f} LUFS")
+        else:
+            rms = np.sqrt(self.sum_squares / self.count) if self.count else 0.0
+            gain = target_rms / rms if rms > 0 else 1.0
+        return gain, self.peak * gain > 0.95
+
+def apply_normalization_block(block, gain, soft_limit):
+    """
+    Применяет усиление и мягкое ограничение к блоку на месте
+    """
+    block *= gain
+    if soft_limit:
+        block *= 0.9
+        np.tanh(block, out=block)
+        block *= 0.9
+    return block
+
+def write_normalized_stream(blocks_factory, output_path, sr, channels, stats, output_format,
+                            target_lufs=None):
+    """
+    Второй проход: нормализует блоки и пишет результат в нужном формате
+    """
+    gain, soft_limit = stats.normalization_gain(target_lufs=target_lufs)
+    
+    # MP3 кодируется ffmpeg параллельно с нормализацией, без временного WAV
+    with open_audio_writer(output_path, sr, channels, output_format) as writer:
+        for block in blocks_factory():
+            writer.write(apply_normalization_block(block, gain, soft_limit))
+    return output_path
+
+def render_file_streaming(input_path, output_path, speed, preserve_pitch, output_format,
+                          target_lufs=None, cancel_path=None, shared_wav_path=None):
+    """
+    Потоковый рендеринг длинного трека с ограниченным потреблением памяти.
+    shared_wav_path - уже декодированный общий WAV (см. prepare_streaming_input),
+    им владеет вызывающий
+    """
+    import subprocess
+    
+    if shared_wav_path is not None:
+        wav_path = shared_wav_path
+    elif input_path.lower().endswith('.wav'):
+        wav_path = input_path
+    else:
+        # ffmpeg декодирует файл в файл потоком, не загружая трек в память
+        wav_path = convert_to_wav_if_needed(input_path)
+    work_dir = os.path.dirname(output_path)
+    token = uuid.uuid4().hex
+    rendered_path = os.path.join(work_dir, f'stream_{token}.wav')
+    scratch_path = os.path.join(work_dir, f'stream_{token}.f32')
+    
+    try:
+        read_block, n_samples, channels, sr = open_wav_block_source(wav_path)
+        print(f"🌊 Потоковый рендеринг: {n_samples / sr:.0f} с, {channels} канал(ов)")
+        
+        rendered = None
+        if preserve_pitch and best_engine('stretch') == 'rubberband':
+            # Rubber Band сам работает с файлами потоково: результат не грузим
+            # в память целиком, а читаем блоками через mmap
+            cmd = build_rubberband_command(wav_path, rendered_path, speed, preserve_pitch)
+            print(f"🔧 Команда Rubber Band: {' '.join(cmd)}")
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode == 0:
+                rendered = open_wav_block_source(rendered_path)
+                print("✅ Использован Rubber Band алгоритм")
+            else:
+                print(f"⚠️ Ошибка команды Rubber Band: {result.stderr}")
+                print("🔄 Переключаемся на потоковый STFT алгоритм")
+        
+        if rendered is not None:
+            read_out, out_samples, channels, sr = rendered
+            
+            def blocks_factory():
+                for start in range(0, out_samples, STREAM_BLOCK_SAMPLES):
+                    yield read_out(start, min(start + STREAM_BLOCK_SAMPLES, out_samples))
+            
+            check_render_cancelled(cancel_path)
+            stats = AudioStats(sr if target_lufs is not None else None)
+            for block in blocks_factory():
+                stats.update(block)
+        else:
+            if channels == 1:
+                # Как и в обычном пути, моно превращаем в стерео
+                mono_read = read_block
+                read_block = lambda start, stop: np.repeat(mono_read(start, stop), 2, axis=0)
+                channels = 2
+            
+            if preserve_pitch:
+                blocks = stream_stretch_blocks(read_block, n_samples, speed)
+            else:
+                blocks = stream_resample_blocks(read_block, n_samples, speed)
+            
+            # Первый проход: рендерим в float32 черновик, собирая статистику
+            stats = AudioStats(sr if target_lufs is not None else None)
+            with open(scratch_path, 'wb') as scratch:
+                for block in blocks:
+                    check_render_cancelled(cancel_path)
+                    stats.update(block)
+                    np.ascontiguousarray(block.T).tofile(scratch)
+            
+            scratch_data = np.memmap(scratch_path, dtype=np.float32, mode='r').reshape(-1, channels)
+            
+            def blocks_factory():
+                for start in range(0, scratch_data.shape[0], STREAM_BLOCK_SAMPLES):
+                    yield np.array(scratch_data[start:start + STREAM_BLOCK_SAMPLES].T)
+        
+        return write_normalized_stream(blocks_factory, output_path, sr, channels, stats, output_format,
+                                       target_lufs)
+        
+    finally:
+        for path in (rendered_path, scratch_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        if wav_path not in (input_path, shared_wav_path):
+            try:
+                os.unlink(wav_path)
+            except OSError:
+                pass
+
+def prepare_streaming_input(input_path, work_prefix):
+    """
+    Общий вход для потокового рендеринга длинного трека на нескольких
+    скоростях: ffmpeg декодирует его в WAV один раз, рендеры скоростей
+    читают этот файл. Файл лежит в рабочем каталоге запроса и удаляется
+    вместе с ним
+    """
+    wav_path = decode_audio_to_wav(input_path, work_prefix + '.stream.wav')
+    print(f"📦 Подготовлен общий вход для потокового рендеринга: {input_path}")
+    return {'wav_path': wav_path}
+
+def prepare_shared_input(input_path, content_hash, work_prefix, with_stft):
+    """
+    Общая подготовка входа для рендеринга одного файла на нескольких
+    скоростях: декодирование (и для Custom STFT - прямое STFT) делается
+    один раз, результаты сохраняются в .npy для открытия через mmap
+    """
+    y, sr = load_decoded_audio(input_path, content_hash)
+    
+    pcm_path = work_prefix + '.pcm.npy'
+    copied = PCM_CACHE is not None and content_hash and \
+        PCM_CACHE.get_into(pcm_cache_key(content_hash, render_decoder(input_path)), '.npy', pcm_path)
+    if not copied:
+        np.save(pcm_path, np.ascontiguousarray(y, dtype=np.float32))
+    shared = {'pcm_path': pcm_path, 'sr': int(sr)}
+    
+    if with_stft:
+        if y.ndim == 1:
+            y = np.array([y, y])
+        stft_path = work_prefix + '.stft.npy'
+        stft = custom_stft(y, SHARED_STFT_N_FFT, SHARED_STFT_N_FFT // 4)
+        np.save(stft_path, stft.astype(np.complex64, copy=False))
+        del stft
+        shared['stft_path'] = stft_path
+    
+    print(f"📦 Подготовлен общий вход: {input_path}")
+    return shared
+
+def render_shared_input(shared, speed, preserve_pitch):
+    """
+    Рендеринг одной скорости из общего подготовленного входа
+    """
+    y = np.load(shared['pcm_path'], mmap_mode='r')
+    sr = shared['sr']
+    
+    if preserve_pitch and 'stft_path' in shared:
+        try:
+            stft = np.load(shared['stft_path'], mmap_mode='r')
+            hop_length = SHARED_STFT_N_FFT // 4
+            stretched = stretch_stft(stft, speed, hop_length)
+            print("✅ Использован Custom STFT с общим прямым STFT")
+            return custom_istft(stretched, hop_length), sr
+        except Exception as e:
+            print(f"Ошибка custom STFT: {e}")
+    
+    return process_decoded_audio(y, sr, speed, preserve_pitch)
+
+# ---------------------------------------------------------------------------
+# Регистрация движков (см. реестр в начале модуля)
+# ---------------------------------------------------------------------------
+
+def has_rubberband_cli():
+    return probe_command('rubberband', '--version') is not None
+
+def has_ffmpeg():
+    return (probe_command('ffmpeg', '-version') is not None
+            and probe_command('ffprobe', '-version') is not None)
+
+def has_ffmpeg_mp3_encoder():
+    encoders = probe_command('ffmpeg', '-hide_banner', '-encoders')
+    return encoders is not None and 'libmp3lame' in encoders
+
+def soundfile_formats():
+    if not HAS_SOUNDFILE:
+        return {}
+    try:
+        return sf.available_formats()
+    except Exception:
+        return {}
+
+SOUNDFILE_EXTENSIONS = {'.' + fmt.lower() for fmt in soundfile_formats()} | {'.wav'}
+
+@register_engine('stretch', 'rubberband', priority=30, probe=has_rubberband_cli)
+def stretch_with_rubberband(y, sr, speed_factor):
+    processed, out_sr = process_with_rubberband_shm(y, sr, speed_factor, True)
+    print("✅ Использован Rubber Band алгоритм")
+    return processed, out_sr
+
+@register_engine('stretch', 'custom_stft', priority=10)
+def stretch_with_custom_stft(y, sr, speed_factor):
+    return process_loaded_audio(y, sr, speed_factor, True)
+
+@register_engine('varispeed', 'polyphase', priority=10)
+def varispeed_with_polyphase(y, sr, speed_factor):
+    return process_loaded_audio(y, sr, speed_factor, False)
+
+@register_engine('decode', 'mmap_wav', priority=30, extensions={'.wav'})
+def decode_with_mmap(audio_path):
+    return decode_wav_mmap(audio_path)
+
+@register_engine('decode', 'ffmpeg', priority=20, probe=has_ffmpeg,
+                 extensions=FFMPEG_DECODE_EXTENSIONS | {'.wav'})
+def decode_with_ffmpeg(audio_path):
+    return decode_audio_with_ffmpeg(audio_path)
+
+@register_engine('decode', 'soundfile', priority=10, probe=lambda: HAS_SOUNDFILE,
+                 extensions=SOUNDFILE_EXTENSIONS)
+def decode_with_soundfile(audio_path):
+    return decode_audio_with_soundfile(audio_path)
+
+@register_engine('encode_mp3', 'ffmpeg', priority=20, probe=has_ffmpeg_mp3_encoder)
+def encode_mp3_with_ffmpeg(output_path, sr, channels):
+    return Mp3PipeWriter(output_path, sr, channels)
+
+@register_engine('encode_mp3', 'soundfile', priority=10, probe=lambda: 'MP3' in soundfile_formats())
+def encode_mp3_with_soundfile(output_path, sr, channels):
+    return SoundFileWriter(output_path, sr, channels, 'MP3', 'MPEG_LAYER_III')
+
+# Проверка выполняется при импорте: в каждом воркере и процессе пула
+probe_engines()
+
+# Параметры прямого STFT, которое делится между скоростями одного файла
+SHARED_STFT_N_FFT = 2048
+
+class RenderCancelled(Exception):
+    """Рендер прерван: задача отменена пользователем"""
+
+def check_render_cancelled(cancel_path):
+    if cancel_path and os.path.exists(cancel_path):
+        raise RenderCancelled('Задача отменена')
+
+def render_file_job(input_path, output_path, speed, preserve_pitch, output_format,
+                    cache_key=None, content_hash=None, shared=None, target_lufs=None,
+                    cancel_path=None):
     """
-    Fallback обработка без librosa - используем только scipy и numpy
+    Полный цикл рендеринга одного файла: декодирование, растяжение,
+    нормализация и сохранение. Выполняется в процессе пула рендеринга.
+    cancel_path - файл-флаг отмены задачи, проверяется между этапами
     """
-    try:
-        # Загружаем аудио напрямую через scipy
-        y, sr = load_audio_with_scipy(audio_path)
-        
-        if y.ndim == 1:
-            y = np.array([y, y])
-        
-        if preserve_pitch:
-            # Используем собственный STFT для сохранения тональности
-            processed = process_with_custom_stft_stretch(y, speed_factor, sr)
+    check_render_cancelled(cancel_path)
+    count_render(output_format, 'miss')
+    duration = probe_audio_duration(input_path)
+    if duration is not None and duration > STREAMING_THRESHOLD_SECONDS:
+        with stage_timer('render', 'streaming'):
+            final_path = render_file_streaming(input_path, output_path, speed, preserve_pitch, output_format,
+                                               target_lufs, cancel_path,
+                                               shared.get('wav_path') if shared else None)
+    else:
+        if shared is not None:
+            with stage_timer('render', 'stretch'):
+                processed_audio, sr = render_shared_input(shared, speed, preserve_pitch)
         else:
-            # Простое изменение скорости через ресэмплинг
-            processed = process_with_resampling(y, speed_factor, sr)
+            processed_audio, sr = process_audio_with_rubberband(
+                input_path, speed, preserve_pitch, content_hash
+            )
+        check_render_cancelled(cancel_path)
         
-        return processed, sr
+        print(f"🔧 Нормализация аудио...")
+        with stage_timer('render', 'normalize'):
+            processed_audio = normalize_audio(processed_audio, sr, target_lufs)
         
-    except Exception as e:
-        print(f"Ошибка обработки: {e}")
-        # Последний fallback - простая интерполяция
-        return process_audio_simple_fallback(audio_path, speed_factor)
+        # Сохраняем результат в выбранном формате
+        print(f"💾 Сохраняем результат в формате {output_format.upper()}: {processed_audio.shape}, sr={sr}")
+        with stage_timer('render', 'encode'):
+            final_path = save_audio_in_format(output_path, processed_audio, sr, output_format)
+    
+    check_render_cancelled(cancel_path)
+    if cache_key and RENDER_CACHE is not None:
+        RENDER_CACHE.put(cache_key, '.' + output_format, final_path)
+    
+    return final_path
 
-def load_audio_with_scipy(audio_path):
+def submit_task_render(task, preserve_pitch, output_format):
     """
-    Загрузка аудио файлов через scipy без librosa
+    Отправляет задачу в пул рендеринга; при попадании в кэш рендеров
+    результат отдается сразу, без запуска движков
     """
-    try:
-        from scipy.io import wavfile
-        import os
-        
-        # Проверяем расширение файла
-        _, ext = os.path.splitext(audio_path.lower())
-        
-        if ext == '.wav':
-            # Загружаем WAV файл
-            sr, data = wavfile.read(audio_path)
-            
-            # Конвертируем в float
-            if data.dtype == np.int16:
-                data = data.astype(np.float32) / 32768.0
-            elif data.dtype == np.int32:
-                data = data.astype(np.float32) / 2147483648.0
-            elif data.dtype == np.uint8:
-                data = (data.astype(np.float32) - 128) / 128.0
-            
-            # Если стерео, транспонируем для правильного формата
-            if data.ndim == 2:
-                data = data.T  # (channels, samples)
-            
-            return data, sr
-            
-        elif ext == '.mp3':
-            # Для MP3 используем простое преобразование через временный WAV
-            return convert_mp3_to_wav_and_load(audio_path)
-        else:
-            raise ValueError(f"Неподдерживаемый формат: {ext}")
-            
-    except Exception as e:
-        print(f"Ошибка загрузки аудио: {e}")
-        raise
+    if RENDER_CACHE is not None and RENDER_CACHE.get_into(
+            task['cache_key'], '.' + output_format, task['output_path']):
+        print(f"⚡ Результат для {task['filename']} найден в кэше")
+        count_render(output_format, 'hit')
+        future = Future()
+        future.set_result(task['output_path'])
+        return future
+    
+    return submit_render(
+        render_file_job, task['input_path'], task['output_path'],
+        task['speed'], preserve_pitch, output_format,
+        task['cache_key'], task['content_hash'], task.get('shared'), task.get('target_lufs'),
+        task.get('cancel_path')
+    )
 
-def convert_mp3_to_wav_and_load(mp3_path):
+def submit_render_tasks(tasks, preserve_pitch, output_format):
     """
-    Конвертация MP3 в WAV и загрузка через pydub
+    Отправляет все задачи запроса в пул рендеринга. Если один файл
+    рендерится на нескольких скоростях, его декодирование (и прямое STFT)
+    выполняется один раз, а скорости рендерятся параллельно
     """
-    try:
-        from pydub import AudioSegment
-        import tempfile
-        import os
-        
-        print("🎵 Конвертируем MP3 файл...")
-        
-        # Загружаем MP3 через pydub
-        audio = AudioSegment.from_mp3(mp3_path)
-        
-        # Конвертируем в numpy array
-        samples = audio.get_array_of_samples()
-        audio_data = np.array(samples, dtype=np.float32)
-        
-        # Нормализуем
-        if audio.sample_width == 2:  # 16-bit
-            audio_data = audio_data / 32768.0
-        elif audio.sample_width == 4:  # 32-bit
-            audio_data = audio_data / 2147483648.0
-        
-        # Обрабатываем стерео
-        if audio.channels == 2:
-            audio_data = audio_data.reshape((-1, 2)).T
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task['input_path'], []).append(task)
+    
+    chained = {}
+    for input_path, group in groups.items():
+        misses = [
+            task for task in group
+            if RENDER_CACHE is None or RENDER_CACHE.get(task['cache_key'], '.' + output_format) is None
+        ]
+        if len(misses) < 2:
+            continue
+        
+        # Общий вход готовится в пуле, а рендеры скоростей отправляет фоновый
+        # поток: поток запроса не ждет декодирования и сразу получает futures.
+        # Длинные треки рендерятся потоково: общим входом для них служит
+        # один декодированный WAV (WAV на входе и так читается напрямую)
+        work_prefix = os.path.splitext(input_path)[0]
+        duration = probe_audio_duration(input_path)
+        if duration is not None and duration > STREAMING_THRESHOLD_SECONDS:
+            if input_path.lower().endswith('.wav'):
+                continue
+            prepare_future = submit_render(prepare_streaming_input, input_path, work_prefix)
         else:
-            # Моно -> стерео
-            audio_data = np.array([audio_data, audio_data])
-        
-        return audio_data, audio.frame_rate
-        
-    except ImportError:
-        print("⚠️ pydub недоступен, используем базовую загрузку")
-        return load_mp3_basic(mp3_path)
-    except Exception as e:
-        print(f"⚠️ Ошибка конвертации MP3: {e}")
-        return load_mp3_basic(mp3_path)
+            with_stft = preserve_pitch and best_engine('stretch') != 'rubberband'
+            prepare_future = submit_render(
+                prepare_shared_input, input_path, group[0]['content_hash'], work_prefix, with_stft
+            )
+        proxies = [Future() for _ in misses]
+        threading.Thread(
+            target=chain_shared_renders, name='slowler-shared-input', daemon=True,
+            args=(prepare_future, misses, proxies, preserve_pitch, output_format)
+        ).start()
+        chained.update((id(task), proxy) for task, proxy in zip(misses, proxies))
+    
+    return [
+        (task, chained.get(id(task)) or submit_task_render(task, preserve_pitch, output_format))
+        for task in tasks
+    ]
 
-def load_mp3_basic(mp3_path):
+def chain_shared_renders(prepare_future, tasks, proxies, preserve_pitch, output_format):
     """
-    Базовая загрузка MP3 через ffmpeg
+    Дожидается общего входа и отправляет рендеры скоростей в пул. Результат
+    каждого рендера переносится в выданный заранее future задачи; если
+    подготовка не удалась, скорости рендерятся независимо
     """
     try:
-        import subprocess
-        import tempfile
-        import os
-        
-        # Создаем временный WAV файл
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-            temp_wav_path = temp_wav.name
-        
-        # Конвертируем через ffmpeg
-        cmd = [
-            'ffmpeg', '-i', mp3_path, 
-            '-acodec', 'pcm_s16le', 
-            '-ar', '44100', 
-            '-ac', '2',
-            '-y', temp_wav_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            # Загружаем конвертированный WAV
-            data, sr = load_audio_with_scipy(temp_wav_path)
-            os.unlink(temp_wav_path)  # Удаляем временный файл
-            return data, sr
-        else:
-            print(f"⚠️ Ошибка ffmpeg: {result.stderr}")
-            raise Exception("Не удалось конвертировать MP3")
-            
+        shared = prepare_future.result()
+        for task in tasks:
+            task['shared'] = shared
+    except BrokenProcessPool:
+        reset_render_pool()
     except Exception as e:
-        print(f"⚠️ Ошибка базовой загрузки MP3: {e}")
-        # Последний fallback - создаем тишину правильной длины
-        return create_silence_fallback()
+        print(f"⚠️ Ошибка подготовки общего входа: {e}, скорости рендерятся независимо")
+    
+    for task, proxy in zip(tasks, proxies):
+        # Отмененные до отправки задачи в пул не попадают
+        if not proxy.set_running_or_notify_cancel():
+            continue
+        try:
+            future = submit_task_render(task, preserve_pitch, output_format)
+        except Exception as e:
+            proxy.set_exception(e)
+            continue
+        future.add_done_callback(lambda done, proxy=proxy: copy_future_outcome(done, proxy))
+
+def copy_future_outcome(source, target):
+    """
+    Переносит результат или ошибку одного future в другой
+    """
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Проверка работоспособности сервера"""
+    return jsonify({
+        'status': 'healthy',
+        'message': 'Audio processing server is running',
+        'engines': engine_status()
+    })
+
+def start_metrics_server():
+    """
+    HTTP сервер метрик на внутреннем порту METRICS_PORT: метрики всех
+    процессов из общего каталога. Под gunicorn его запускает мастер
+    (gunicorn.conf.py), здесь - для python app.py
+    """
+    if not HAS_PROMETHEUS:
+        return
+    from prometheus_client import multiprocess
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    prometheus_client.start_http_server(METRICS_PORT, addr=METRICS_ADDR, registry=registry)
+    print(f"📈 Метрики Prometheus: http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
 
-def create_silence_fallback():
+@app.route('/spectrogram/<content_hash>/<int:level>/<int:x>/<int:y>.png', methods=['GET'])
+def spectrogram_tile(content_hash, level, x, y):
     """
-    Создает тишину как последний fallback
+    Тайл пирамиды спектрограммы. Содержимое определяется хэшем трека,
+    поэтому тайл кэшируется клиентом навсегда и проверяется по ETag
     """
-    sr = 44100
-    duration = 30  # 30 секунд тишины
-    samples = sr * duration
+    if not CONTENT_HASH_PATTERN.match(content_hash):
+        return jsonify({'error': 'Неверный идентификатор трека'}), 404
     
-    # Создаем тишину
-    silence = np.zeros((2, samples), dtype=np.float32)
+    etag = f'{SPECTROGRAM_VERSION}-{content_hash[:32]}-{level}-{x}-{y}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        png = get_spectrogram_tile(content_hash, level, x, y)
+        if png is None:
+            return jsonify({'error': 'Тайл не найден, повторите анализ'}), 404
+        response = Response(png, mimetype='image/png')
     
-    return silence, sr
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
-def process_with_custom_stft_stretch(y, speed_factor, sr):
+class RenderFailed(Exception):
+    """Ошибка рендеринга одного из файлов запроса"""
+
+def wait_render_result(futures, index):
     """
-    Собственная реализация STFT растяжения без librosa
+    Дожидается результата рендеринга файла с номером index.
+    При ошибке отменяет оставшиеся задачи и кидает RenderFailed
     """
+    task, future = futures[index]
+    filename = task['filename']
     try:
-        # Параметры STFT
-        n_fft = 2048
-        hop_length = n_fft // 4
-        
-        processed_channels = []
-        
-        for channel in range(y.shape[0]):
-            # Собственная реализация STFT
-            stft = custom_stft(y[channel], n_fft, hop_length)
-            
-            # Растягиваем по времени
-            stretched_stft = stretch_stft(stft, speed_factor)
-            
-            # Обратное STFT
-            stretched_audio = custom_istft(stretched_stft, hop_length)
-            processed_channels.append(stretched_audio)
-        
-        return np.array(processed_channels)
-        
+        final_path = future.result()
+        print(f"✅ Файл {filename} обработан успешно")
+        return final_path
+    except BrokenProcessPool as e:
+        print(f"❌ Пул рендеринга аварийно завершился: {e}")
+        reset_render_pool()
+        message = f'Ошибка обработки файла {filename}: процесс рендеринга аварийно завершился'
     except Exception as e:
-        print(f"Ошибка custom STFT: {e}")
-        # Fallback на простую интерполяцию
-        return process_simple_stretch(y, speed_factor)
+        print(f"❌ Ошибка обработки файла {filename}: {e}")
+        message = f'Ошибка обработки файла {filename}: {str(e)}'
+    
+    for _, pending in futures:
+        pending.cancel()
+    raise RenderFailed(message)
 
-def custom_stft(signal, n_fft, hop_length):
+def parse_render_request():
     """
-    Собственная реализация STFT
+    Разбор формы запроса на рендеринг (общий для /process и /jobs).
+    Возвращает (files, speeds, preserve_pitch, output_format, target_lufs),
+    при ошибке кидает ValueError
     """
-    # Создаем окно Хэннинга
-    window = np.hanning(n_fft)
+    # Проверяем наличие файлов
+    if 'files' not in request.files:
+        raise ValueError('Файлы не найдены')
     
-    # Количество кадров
-    n_frames = (len(signal) - n_fft) // hop_length + 1
+    files = request.files.getlist('files')
+    speeds = request.form.getlist('speeds')
+    preserve_pitch = request.form.get('preserve_pitch', 'true').lower() == 'true'
+    output_format = request.form.get('output_format', 'wav').lower()
     
-    # Матрица STFT
-    stft_matrix = np.zeros((n_fft // 2 + 1, n_frames), dtype=complex)
+    # Один файл и несколько скоростей - рендеринг файла на каждой скорости
+    if len(files) != len(speeds) and not (len(files) == 1 and len(speeds) > 1):
+        raise ValueError('Количество файлов и скоростей не совпадает')
     
-    for i in range(n_frames):
-        start = i * hop_length
-        end = start + n_fft
-        
-        if end <= len(signal):
-            # Извлекаем кадр и применяем окно
-            frame = signal[start:end] * window
-            
-            # FFT
-            fft_frame = np.fft.rfft(frame)
-            stft_matrix[:, i] = fft_frame
+    # Проверяем поддерживаемые форматы
+    if output_format not in ['wav', 'mp3']:
+        raise ValueError(f'Неподдерживаемый формат: {output_format}. Поддерживаются: wav, mp3')
     
-    return stft_matrix
+    # Целевая громкость в LUFS; без нее - RMS нормализация
+    target_lufs = parse_target_lufs(request.form.get('target_lufs', ''))
+    if target_lufs is None:
+        target_lufs = NORMALIZATION_TARGET_LUFS
+    
+    return files, speeds, preserve_pitch, output_format, target_lufs
 
-def custom_istft(stft_matrix, hop_length):
+def save_render_inputs(files, speeds, preserve_pitch, output_format, work_dir, target_lufs=None):
     """
-    Улучшенная реализация обратного STFT с правильной нормализацией
+    Проверяет скорости и сохраняет входные файлы в рабочую директорию.
+    Возвращает список задач рендеринга, при ошибке кидает ValueError
     """
-    n_fft = (stft_matrix.shape[0] - 1) * 2
-    n_frames = stft_matrix.shape[1]
-    
-    # Создаем окно
-    window = np.hanning(n_fft)
-    
-    # Длина выходного сигнала
-    signal_length = (n_frames - 1) * hop_length + n_fft
-    reconstructed = np.zeros(signal_length)
-    window_sum = np.zeros(signal_length)
+    parsed_speeds = []
+    for speed_str in speeds:
+        try:
+            speed = float(speed_str)
+        except ValueError:
+            raise ValueError(f'Недопустимое значение скорости: {speed_str}')
+        if speed <= 0 or speed > 10:
+            raise ValueError(f'Недопустимая скорость: {speed}')
+        parsed_speeds.append(speed)
     
-    for i in range(n_frames):
-        start = i * hop_length
-        end = start + n_fft
-        
-        if end <= len(reconstructed):
-            # Обратное FFT
-            frame = np.fft.irfft(stft_matrix[:, i], n_fft)
-            
-            # Применяем окно и добавляем к результату
-            windowed_frame = frame * window
-            reconstructed[start:end] += windowed_frame
-            window_sum[start:end] += window * window
+    # Режим нескольких скоростей: файл сохраняется один раз, повторы скоростей
+    # отбрасываются - одна скорость дает один рендер и один выходной файл
+    fan_out = len(files) == 1 and len(parsed_speeds) > 1
+    if fan_out:
+        parsed_speeds = list(dict.fromkeys(parsed_speeds))
+        names = [f'{speed:g}' for speed in parsed_speeds]
+        if len(set(names)) != len(names):
+            raise ValueError('Скорости должны различаться в пределах 6 значащих цифр')
+    pairs = [(files[0], speed) for speed in parsed_speeds] if fan_out else zip(files, parsed_speeds)
     
-    # Нормализуем по сумме окон для избежания искажений
-    nonzero_indices = window_sum > 1e-10
-    reconstructed[nonzero_indices] /= window_sum[nonzero_indices]
+    tasks = []
+    saved = {}
+    used_names = set()
+    for i, (file, speed) in enumerate(pairs):
+        if file.filename == '':
+            continue
+        
+        # Сохраняем входной файл, попутно считая хэш содержимого для кэша
+        if id(file) not in saved:
+            input_path = os.path.join(work_dir, f'input_{i}_{file.filename}')
+            saved[id(file)] = (input_path, save_upload_with_hash(file, input_path))
+        input_path, content_hash = saved[id(file)]
+        
+        # Определяем имя и путь выходного файла в зависимости от формата
+        base_name = os.path.splitext(file.filename)[0]
+        if fan_out:
+            output_filename = f"{base_name}_{speed:g}x_slowed.{output_format}"
+        else:
+            output_filename = f"{base_name}_slowed.{output_format}"
+        
+        # Файлы с одинаковыми именами получают суффикс: у каждой задачи
+        # свой выходной путь, иначе рендеры перезаписывали бы друг друга
+        stem, extension = os.path.splitext(output_filename)
+        counter = 2
+        while output_filename in used_names:
+            output_filename = f"{stem}_{counter}{extension}"
+            counter += 1
+        used_names.add(output_filename)
+        
+        tasks.append({
+            'filename': file.filename,
+            'input_path': input_path,
+            'output_path': os.path.join(work_dir, output_filename),
+            'output_filename': output_filename,
+            'speed': speed,
+            'content_hash': content_hash,
+            'target_lufs': target_lufs,
+            'cache_key': render_cache_key(content_hash, speed, preserve_pitch, output_format, target_lufs)
+        })
     
-    return reconstructed
+    return tasks
 
-def process_audio_simple_fallback(audio_path, speed_factor):
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+
+def zip_compression_for(filename):
     """
-    Последний fallback - создаем синтетический результат
+    Метод сжатия для элемента архива: MP3 уже сжат, поэтому хранится как есть
     """
-    print("⚠️ Используем синтетический fallback")
-    
-    # Создаем простой синтетический сигнал
-    sr = 44100
-    duration = int(10 / speed_factor)  # Изменяем длительность в зависимости от скорости
-    t = np.linspace(0, duration, sr * duration)
+    if filename.lower().endswith('.mp3'):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def build_results_zip(target, processed_files):
+    """
+    Записывает обработанные файлы в ZIP архив (путь или файловый объект)
+    """
+    with zipfile.ZipFile(target, 'w') as zip_file:
+        for file_path, filename in processed_files:
+            zip_file.write(file_path, filename, compress_type=zip_compression_for(filename))
+
+class ZipStreamBuffer:
+    """
+    Неперематываемый приемник для zipfile: накапливает байты архива
+    до тех пор, пока генератор ответа не отдаст их клиенту
+    """
+    def __init__(self):
+        self._chunks = []
     
-    # Синтетический сигнал
-    freq = 440
-    signal = 0.3 * np.sin(2 * np.pi * freq * t)
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
     
-    # Стерео версия
-    stereo_signal = np.array([signal, signal])
+    def flush(self):
+        pass
     
-    return stereo_signal, sr
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
 
-def process_with_stft_stretch(y, speed_factor, sr):
+def stream_zip_entry(zip_file, buffer, file_path, filename):
     """
-    Растяжение времени с сохранением тональности через STFT
+    Записывает файл в потоковый ZIP по частям, отдавая готовые байты
     """
+    info = zipfile.ZipInfo.from_file(file_path, filename)
+    info.compress_type = zip_compression_for(filename)
+    
+    with open(file_path, 'rb') as src, zip_file.open(info, 'w') as dst:
+        while True:
+            chunk = src.read(ZIP_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+            data = buffer.drain()
+            if data:
+                yield data
+    
+    data = buffer.drain()
+    if data:
+        yield data
+
+@app.route('/process', methods=['POST'])
+def process_audio():
+    """Основной эндпоинт для обработки аудио файлов"""
     try:
-        # Параметры STFT
-        n_fft = 2048
-        hop_length = n_fft // 4
+        try:
+            files, speeds, preserve_pitch, output_format, target_lufs = parse_render_request()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        print(f"🎵 Начинаем обработку {len(files)} файлов в формате {output_format.upper()}")
+        print(f"⚙️ Настройки: preserve_pitch={preserve_pitch}")
         
-        processed_channels = []
+        # Создаем временную директорию для обработки
+        temp_dir = tempfile.mkdtemp()
+        streaming = False
         
-        for channel in range(y.shape[0]):
-            # Прямое STFT
-            stft = librosa.stft(y[channel], n_fft=n_fft, hop_length=hop_length)
+        try:
+            # Сначала проверяем параметры и сохраняем все входные файлы
+            try:
+                with stage_timer('process', 'upload_save'):
+                    tasks = save_render_inputs(files, speeds, preserve_pitch, output_format, temp_dir,
+                                               target_lufs)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
             
-            # Растягиваем по времени
-            stretched_stft = stretch_stft(stft, speed_factor)
+            if not tasks:
+                return jsonify({'error': 'Нет файлов для обработки'}), 400
             
-            # Обратное STFT
-            stretched_audio = librosa.istft(stretched_stft, hop_length=hop_length)
-            processed_channels.append(stretched_audio)
-        
-        return np.array(processed_channels)
-        
+            # Рендерим файлы параллельно в пуле процессов
+            for task in tasks:
+                print(f"📁 Отправляем в обработку: {task['filename']}")
+                print(f"🎛️ Скорость: {task['speed']}x, Формат: {output_format.upper()}")
+            futures = submit_render_tasks(tasks, preserve_pitch, output_format)
+            
+            # Ждем первый результат до начала ответа: если рендеринг падает сразу,
+            # клиент получает JSON с ошибкой, а не оборванный архив
+            try:
+                first_path = wait_render_result(futures, 0)
+            except RenderFailed as e:
+                return jsonify({'error': str(e)}), 500
+            
+            def generate():
+                """Отдает ZIP по мере готовности файлов, в порядке отправки"""
+                buffer = ZipStreamBuffer()
+                try:
+                    with zipfile.ZipFile(buffer, 'w') as zip_file:
+                        for index, (task, future) in enumerate(futures):
+                            if index == 0:
+                                final_path = first_path
+                            else:
+                                with stage_timer('process', 'render_wait'):
+                                    final_path = wait_render_result(futures, index)
+                            yield from timed_chunks(stream_zip_entry(
+                                zip_file, buffer, final_path, task['output_filename']
+                            ), 'process', 'zip')
+                            # Файл уже отдан клиенту - освобождаем место на диске
+                            try:
+                                os.unlink(final_path)
+                            except OSError:
+                                pass
+                    yield buffer.drain()
+                    print("✅ Обработка завершена!")
+                    
+                except GeneratorExit:
+                    print("⚠️ Клиент отключился во время загрузки архива")
+                    raise
+                except Exception as e:
+                    # Заголовки уже отправлены: единственный способ сообщить об
+                    # ошибке - оборвать соединение с неполным архивом
+                    print(f"❌ Ошибка во время отдачи архива: {e}")
+                    raise
+            
+            def cleanup():
+                # Вызывается при закрытии ответа, даже если генератор не был
+                # запущен (клиент отключился до первого фрагмента)
+                for _, pending in futures:
+                    pending.cancel()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            
+            print("📦 Отдаем ZIP архив потоком...")
+            response = Response(generate(), mimetype='application/zip')
+            response.call_on_close(cleanup)
+            response.headers['Content-Disposition'] = 'attachment; filename=slowed_audio_files.zip'
+            response.headers['X-Accel-Buffering'] = 'no'
+            streaming = True
+            return response
+            
+        finally:
+            # Очищаем временные файлы (при потоковой отдаче - при закрытии ответа)
+            if not streaming:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                
     except Exception as e:
-        print(f"Ошибка STFT: {e}")
-        # Fallback на простую интерполяцию
-        return process_simple_stretch(y, speed_factor)
+        print(f"Общая ошибка: {e}")
+        return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
+
+# ---------------------------------------------------------------------------
+# Асинхронные задачи рендеринга: /jobs, /progress/<id>, /cancel/<id>
+#
+# Состояние задачи хранится на диске (JOBS_FOLDER/<job_id>/job.json), поэтому
+# статус, отмена и скачивание работают в любом воркере gunicorn, а не только
+# в том, который принял загрузку. Фоновые потоки каждого воркера забирают
+# задачи из очереди через атомарный claim-файл.
+# ---------------------------------------------------------------------------
+
+JOBS_FOLDER = os.environ.get('JOBS_FOLDER', os.path.join(tempfile.gettempdir(), 'slowler_jobs'))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 6 * 3600))
+JOB_THREADS = int(os.environ.get('JOB_THREADS', 1))
+# Сколько раз задача перезапускается после гибели воркера, который её выполнял
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_job_wakeup = threading.Event()
+_job_threads = []
+_job_threads_lock = threading.Lock()
 
-def stretch_stft(stft, speed_factor):
+def get_job_dir(job_id):
     """
-    Растяжение STFT матрицы
+    Путь к директории задачи (None для некорректного идентификатора)
     """
-    original_frames = stft.shape[1]
-    new_frames = int(original_frames / speed_factor)
-    
-    # Создаем новую STFT матрицу
-    stretched = np.zeros((stft.shape[0], new_frames), dtype=complex)
-    
-    # Интерполируем фазы и амплитуды
-    for i in range(new_frames):
-        source_frame = i * speed_factor
-        frame_idx = int(source_frame)
-        fraction = source_frame - frame_idx
-        
-        if frame_idx + 1 < original_frames:
-            # Интерполяция амплитуд
-            amp1 = np.abs(stft[:, frame_idx])
-            amp2 = np.abs(stft[:, frame_idx + 1])
-            interp_amp = amp1 * (1 - fraction) + amp2 * fraction
-            
-            # Сохраняем фазу первого кадра для стабильности
-            phase = np.angle(stft[:, frame_idx])
-            
-            stretched[:, i] = interp_amp * np.exp(1j * phase)
-        elif frame_idx < original_frames:
-            stretched[:, i] = stft[:, frame_idx]
-    
-    return stretched
+    if not JOB_ID_PATTERN.match(job_id or ''):
+        return None
+    return os.path.join(JOBS_FOLDER, job_id)
 
-def process_with_resampling(y, speed_factor, sr):
+def read_job(job_id):
     """
-    Простое изменение скорости через ресэмплинг
+    Читает состояние задачи с диска
     """
+    job_dir = get_job_dir(job_id)
+    if job_dir is None:
+        return None
     try:
-        processed_channels = []
-        
-        for channel in range(y.shape[0]):
-            # Изменяем длину сигнала
-            new_length = int(len(y[channel]) / speed_factor)
-            
-            # Простая интерполяция
-            old_indices = np.arange(len(y[channel]))
-            new_indices = np.linspace(0, len(y[channel]) - 1, new_length)
-            
-            resampled = np.interp(new_indices, old_indices, y[channel])
-            processed_channels.append(resampled)
-        
-        return np.array(processed_channels)
-        
-    except Exception as e:
-        print(f"Ошибка ресэмплинга: {e}")
-        return process_simple_stretch(y, speed_factor)
+        with open(os.path.join(job_dir, 'job.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-def process_simple_stretch(y, speed_factor):
+def write_job(job_id, job):
     """
-    Простое растяжение без библиотек
+    Атомарно записывает состояние задачи
     """
-    processed_channels = []
-    
-    for channel in range(y.shape[0]):
-        original_length = len(y[channel])
-        new_length = int(original_length / speed_factor)
-        
-        # Линейная интерполяция
-        old_indices = np.linspace(0, original_length - 1, original_length)
-        new_indices = np.linspace(0, original_length - 1, new_length)
-        
-        stretched = np.interp(new_indices, old_indices, y[channel])
-        processed_channels.append(stretched)
-    
-    return np.array(processed_channels)
+    job_dir = get_job_dir(job_id)
+    job['updated_at'] = time.time()
+    tmp_path = os.path.join(job_dir, f'job.json.{os.getpid()}.{threading.get_ident()}')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(job_dir, 'job.json'))
 
-def process_audio_simple(audio_path, speed_factor):
+@contextlib.contextmanager
+def job_lock(job_id):
     """
-    Простая обработка как последний fallback
+    Эксклюзивная блокировка состояния задачи между потоками и воркерами
     """
-    y, sr = librosa.load(audio_path, sr=None, mono=False)
-    
-    if y.ndim == 1:
-        y = np.array([y, y])
-    
-    # Простая интерполяция
-    original_length = y.shape[1]
-    new_length = int(original_length / speed_factor)
-    
-    processed = np.zeros((y.shape[0], new_length))
-    for channel in range(y.shape[0]):
-        processed[channel] = np.interp(
-            np.linspace(0, original_length - 1, new_length),
-            np.arange(original_length),
-            y[channel]
-        )
-    
-    return processed, sr
+    with open(os.path.join(get_job_dir(job_id), 'lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-def save_with_scipy(output_path, processed_audio, sr):
+def update_job(job_id, only_if=None, **fields):
     """
-    Сохранение аудио через scipy
+    Обновляет поля задачи под блокировкой. only_if - допустимые текущие
+    статусы: в другом статусе задача не изменяется
     """
     try:
-        from scipy.io.wavfile import write
-        
-        # Подготавливаем данные для scipy
-        if processed_audio.ndim == 2:
-            # Для стерео транспонируем: (channels, samples) -> (samples, channels)
-            audio_for_scipy = processed_audio.T
-        else:
-            # Моно
-            audio_for_scipy = processed_audio
-        
-        # Конвертируем в 16-bit integer
-        audio_for_scipy = np.clip(audio_for_scipy, -1.0, 1.0)
-        audio_int16 = (audio_for_scipy * 32767).astype(np.int16)
-        
-        # Записываем WAV файл
-        write(output_path, sr, audio_int16)
-        print(f"✅ Файл сохранен через scipy: {output_path}")
-        
-    except Exception as e:
-        print(f"❌ Ошибка сохранения через scipy: {e}")
-        raise
+        with job_lock(job_id):
+            job = read_job(job_id)
+            if job is None:
+                return None
+            if only_if is not None and job['status'] not in only_if:
+                return job
+            job.update(fields)
+            write_job(job_id, job)
+            return job
+    except OSError:
+        # Директория задачи удалена (истек срок хранения)
+        return None
 
-def normalize_audio(audio):
+def requeue_orphaned_job(job_id):
     """
-    Нормализация аудио с предотвращением клиппинга
+    Возвращает в очередь задачу, воркер которой умер (например, перезапущен
+    gunicorn по max_requests). Готовые файлы при повторе берутся из кэша рендеров
     """
-    # RMS нормализация для более естественного звучания
-    rms = np.sqrt(np.mean(audio**2))
-    if rms > 0:
-        # Целевой RMS уровень
-        target_rms = 0.2
-        audio = audio * (target_rms / rms)
-    
-    # Мягкое ограничение пиков
-    peak = np.max(np.abs(audio))
-    if peak > 0.95:
-        # Используем tanh для мягкого ограничения
-        audio = np.tanh(audio * 0.9) * 0.9
-    
-    return audio
+    try:
+        with job_lock(job_id):
+            job = read_job(job_id)
+            if job is None or job['status'] != 'running' or is_process_alive(job.get('worker_pid', 0)):
+                return job
+            
+            if job.get('attempts', 1) >= JOB_MAX_ATTEMPTS:
+                print(f"❌ Задача {job_id} превысила число попыток")
+                job.update(status='failed', error='Обработчик задачи был остановлен', current_file=None)
+            else:
+                print(f"🔁 Задача {job_id} возвращена в очередь")
+                job.update(status='queued', progress=0.0, files_done=0, current_file=None, worker_pid=None)
+                try:
+                    os.unlink(os.path.join(get_job_dir(job_id), 'claim'))
+                except OSError:
+                    pass
+            write_job(job_id, job)
+            return job
+    except OSError:
+        return None
 
-def save_audio_in_format(output_path, processed_audio, sr, output_format='wav'):
+def claim_job(job_id):
     """
-    Сохранение аудио в указанном формате (WAV или MP3)
+    Атомарно закрепляет задачу за текущим процессом (True при успехе)
     """
     try:
-        if output_format.lower() == 'mp3':
-            # Сохраняем в MP3
-            return save_as_mp3(output_path, processed_audio, sr)
-        else:
-            # Сохраняем в WAV (по умолчанию)
-            return save_as_wav(output_path, processed_audio, sr)
-    except Exception as e:
-        print(f"❌ Ошибка сохранения в формате {output_format}: {e}")
-        raise
+        fd = os.open(os.path.join(get_job_dir(job_id), 'claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
 
-def save_as_wav(output_path, processed_audio, sr):
+def is_job_cancelled(job_id):
+    """
+    Проверяет, запрошена ли отмена задачи
     """
-    Сохранение аудио в формате WAV
+    return os.path.exists(os.path.join(get_job_dir(job_id), 'cancel'))
+
+def is_process_alive(pid):
+    """
+    Проверяет, жив ли процесс с указанным pid
     """
     try:
-        if HAS_SOUNDFILE:
-            # Используем soundfile если доступен
-            try:
-                if processed_audio.ndim == 2:
-                    # soundfile ожидает (samples, channels)
-                    audio_for_sf = processed_audio.T
-                else:
-                    audio_for_sf = processed_audio
-                
-                sf.write(output_path, audio_for_sf, sr, format='WAV', subtype='PCM_16')
-                print(f"✅ WAV файл сохранен через soundfile: {output_path}")
-                return output_path
-            except Exception as e:
-                print(f"⚠️ Ошибка soundfile: {e}, используем scipy")
-                return save_with_scipy(output_path, processed_audio, sr)
-        else:
-            return save_with_scipy(output_path, processed_audio, sr)
-    except Exception as e:
-        print(f"❌ Ошибка сохранения WAV: {e}")
-        raise
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
-def save_as_mp3(output_path, processed_audio, sr):
+def ensure_job_workers():
+    """
+    Запускает фоновые потоки обработки задач в текущем воркере
+    """
+    with _job_threads_lock:
+        _job_threads[:] = [t for t in _job_threads if t.is_alive()]
+        while len(_job_threads) < JOB_THREADS:
+            thread = threading.Thread(target=job_worker_loop, name='slowler-job-worker', daemon=True)
+            thread.start()
+            _job_threads.append(thread)
+
+def next_queued_job():
     """
-    Сохранение аудио в формате MP3
+    Находит самую старую задачу в очереди и закрепляет её за собой
     """
     try:
-        # Сначала сохраняем во временный WAV файл
-        temp_wav_path = output_path.replace('.mp3', '_temp.wav')
-        save_as_wav(temp_wav_path, processed_audio, sr)
-        
-        # Конвертируем WAV в MP3
-        return convert_wav_to_mp3(temp_wav_path, output_path)
-        
-    except Exception as e:
-        print(f"❌ Ошибка сохранения MP3: {e}")
-        raise
+        job_ids = os.listdir(JOBS_FOLDER)
+    except OSError:
+        return None
+    
+    queued = []
+    for job_id in job_ids:
+        job = read_job(job_id)
+        if job and job.get('status') == 'running':
+            job = requeue_orphaned_job(job_id)
+        if job and job.get('status') == 'queued':
+            queued.append((job.get('created_at', 0), job_id))
+    
+    for _, job_id in sorted(queued):
+        if claim_job(job_id):
+            return job_id
+    return None
 
-def convert_wav_to_mp3(wav_path, mp3_path):
+def cleanup_expired_jobs():
     """
-    Конвертация WAV в MP3 через pydub или ffmpeg
+    Удаляет завершенные задачи старше JOB_TTL_SECONDS
     """
     try:
-        # Пробуем использовать pydub
-        from pydub import AudioSegment
-        
-        print(f"🔄 Конвертируем WAV в MP3: {wav_path} -> {mp3_path}")
-        
-        # Загружаем WAV
-        audio = AudioSegment.from_wav(wav_path)
-        
-        # Экспортируем как MP3 с хорошим качеством
-        audio.export(
-            mp3_path,
-            format="mp3",
-            bitrate="320k",  # Высокое качество
-            parameters=["-q:a", "0"]  # Лучшее качество
-        )
-        
-        # Удаляем временный WAV файл
-        try:
-            os.unlink(wav_path)
-        except:
-            pass
-        
-        print(f"✅ MP3 файл создан: {mp3_path}")
-        return mp3_path
-        
-    except ImportError:
-        print("⚠️ pydub недоступен, используем ffmpeg")
-        return convert_wav_to_mp3_with_ffmpeg(wav_path, mp3_path)
-    except Exception as e:
-        print(f"⚠️ Ошибка конвертации через pydub: {e}")
-        return convert_wav_to_mp3_with_ffmpeg(wav_path, mp3_path)
+        job_ids = os.listdir(JOBS_FOLDER)
+    except OSError:
+        return
+    
+    now = time.time()
+    for job_id in job_ids:
+        job = read_job(job_id)
+        if job is None or job.get('status') in ('queued', 'running'):
+            continue
+        if now - job.get('updated_at', now) > JOB_TTL_SECONDS:
+            print(f"🧹 Удаляем устаревшую задачу {job_id}")
+            shutil.rmtree(get_job_dir(job_id), ignore_errors=True)
+
+def job_worker_loop():
+    """
+    Фоновый цикл: забирает задачи из очереди и рендерит их
+    """
+    last_cleanup = 0
+    while True:
+        try:
+            if time.time() - last_cleanup > 60:
+                cleanup_expired_jobs()
+                last_cleanup = time.time()
+            
+            job_id = next_queued_job()
+            if job_id is None:
+                _job_wakeup.wait(timeout=2.0)
+                _job_wakeup.clear()
+                continue
+            
+            run_job(job_id)
+        except Exception as e:
+            print(f"❌ Ошибка фонового обработчика задач: {e}")
+            time.sleep(1.0)
 
-def convert_wav_to_mp3_with_ffmpeg(wav_path, mp3_path):
+def run_job(job_id):
     """
-    Конвертация WAV в MP3 через ffmpeg
+    Рендерит все файлы задачи и собирает ZIP архив результата
     """
+    job = read_job(job_id)
+    if job is None:
+        return
+    job_dir = get_job_dir(job_id)
+    tasks = job['tasks']
+    
+    if is_job_cancelled(job_id):
+        update_job(job_id, status='cancelled')
+        return
+    
+    print(f"🚀 Запускаем задачу {job_id}: {len(tasks)} файлов")
+    update_job(job_id, status='running', worker_pid=os.getpid(), started_at=time.time(),
+               attempts=job.get('attempts', 0) + 1)
+    
+    # Процесс пула проверяет этот файл между этапами и прерывает отмененный рендер
+    for task in tasks:
+        task['cancel_path'] = os.path.join(job_dir, 'cancel')
+    futures = submit_render_tasks(tasks, job['preserve_pitch'], job['output_format'])
+    
+    processed_files = []
     try:
-        import subprocess
-        
-        # Конвертируем через ffmpeg с высоким качеством
-        cmd = [
-            'ffmpeg', '-i', wav_path,
-            '-codec:a', 'libmp3lame',
-            '-b:a', '320k',  # Высокий битрейт
-            '-q:a', '0',     # Лучшее качество
-            '-y', mp3_path
-        ]
+        for index, (task, future) in enumerate(futures):
+            update_job(job_id, current_file=task['filename'])
+            while True:
+                if is_job_cancelled(job_id):
+                    for _, pending in futures:
+                        pending.cancel()
+                    print(f"🛑 Задача {job_id} отменена")
+                    update_job(job_id, status='cancelled', current_file=None)
+                    return
+                try:
+                    final_path = future.result(timeout=0.5)
+                    break
+                except FutureTimeoutError:
+                    continue
+            
+            processed_files.append((final_path, task['output_filename']))
+            update_job(
+                job_id,
+                files_done=index + 1,
+                progress=round((index + 1) * 100.0 / len(tasks), 1)
+            )
+            print(f"✅ Задача {job_id}: файл {task['filename']} обработан")
+        
+        print(f"📦 Задача {job_id}: создание ZIP архива...")
+        result_path = os.path.join(job_dir, 'result.zip')
+        build_results_zip(result_path + '.part', processed_files)
+        os.replace(result_path + '.part', result_path)
+        
+        # Входные и промежуточные файлы больше не нужны
+        for task in tasks:
+            shared = task.get('shared') or {}
+            for path in (task['input_path'], task['output_path'],
+                         shared.get('pcm_path'), shared.get('stft_path')):
+                try:
+                    os.unlink(path)
+                except (OSError, TypeError):
+                    pass
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        update_job(job_id, status='done', progress=100.0, current_file=None, finished_at=time.time())
+        print(f"✅ Задача {job_id} завершена")
         
-        if result.returncode == 0:
-            # Удаляем временный WAV файл
-            try:
-                os.unlink(wav_path)
-            except:
-                pass
-            
-            print(f"✅ MP3 файл создан через ffmpeg: {mp3_path}")
-            return mp3_path
-        else:
-            print(f"⚠️ Ошибка ffmpeg: {result.stderr}")
-            raise Exception("Не удалось конвертировать в MP3")
-            
+    except BrokenProcessPool as e:
+        print(f"❌ Пул рендеринга аварийно завершился: {e}")
+        reset_render_pool()
+        update_job(job_id, status='failed', error='Процесс рендеринга аварийно завершился')
     except Exception as e:
-        print(f"⚠️ Ошибка конвертации через ffmpeg: {e}")
-        raise
-
+        for _, pending in futures:
+            pending.cancel()
+        if is_job_cancelled(job_id):
+            print(f"🛑 Задача {job_id} отменена")
+            update_job(job_id, status='cancelled', current_file=None)
+            return
+        print(f"❌ Ошибка задачи {job_id}: {e}")
+        update_job(job_id, status='failed', error=str(e))
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Проверка работоспособности сервера"""
-    return jsonify({'status': 'healthy', 'message': 'Audio processing server is running'})
+def job_public_view(job_id, job):
+    """
+    Публичное представление состояния задачи для клиента
+    """
+    view = {
+        'job_id': job_id,
+        'status': job['status'],
+        'progress': job.get('progress', 0.0),
+        'files_total': len(job['tasks']),
+        'files_done': job.get('files_done', 0),
+        'current_file': job.get('current_file'),
+        'output_format': job['output_format'],
+        'target_lufs': job.get('target_lufs'),
+        'created_at': job['created_at'],
+        'updated_at': job.get('updated_at'),
+        'error': job.get('error'),
+        'progress_url': f'/progress/{job_id}',
+        'cancel_url': f'/cancel/{job_id}'
+    }
+    if job['status'] == 'done':
+        view['download_url'] = f'/jobs/{job_id}/download'
+    return view
 
-@app.route('/process', methods=['POST'])
-def process_audio():
-    """Основной эндпоинт для обработки аудио файлов"""
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Постановка задачи рендеринга в очередь; сразу возвращает идентификатор задачи"""
     try:
-        # Проверяем наличие файлов
-        if 'files' not in request.files:
-            return jsonify({'error': 'Файлы не найдены'}), 400
-        
-        files = request.files.getlist('files')
-        speeds = request.form.getlist('speeds')
-        preserve_pitch = request.form.get('preserve_pitch', 'true').lower() == 'true'
-        output_format = request.form.get('output_format', 'wav').lower()
-        session_id = request.form.get('session_id', 'default')
-        
-        if len(files) != len(speeds):
-            return jsonify({'error': 'Количество файлов и скоростей не совпадает'}), 400
+        try:
+            files, speeds, preserve_pitch, output_format, target_lufs = parse_render_request()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Проверяем поддерживаемые форматы
-        if output_format not in ['wav', 'mp3']:
-            return jsonify({'error': f'Неподдерживаемый формат: {output_format}. Поддерживаются: wav, mp3'}), 400
+        job_id = uuid.uuid4().hex
+        job_dir = get_job_dir(job_id)
+        os.makedirs(job_dir)
         
-        print(f"🎵 Начинаем обработку {len(files)} файлов в формате {output_format.upper()}")
-        print(f"⚙️ Настройки: preserve_pitch={preserve_pitch}")
+        try:
+            tasks = save_render_inputs(files, speeds, preserve_pitch, output_format, job_dir,
+                                       target_lufs)
+        except ValueError as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 400
+        
+        if not tasks:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return jsonify({'error': 'Нет файлов для обработки'}), 400
+        
+        job = {
+            'status': 'queued',
+            'progress': 0.0,
+            'files_done': 0,
+            'tasks': tasks,
+            'preserve_pitch': preserve_pitch,
+            'output_format': output_format,
+            'target_lufs': target_lufs,
+            'created_at': time.time()
+        }
+        write_job(job_id, job)
+        print(f"📥 Задача {job_id} поставлена в очередь: {len(tasks)} файлов")
         
-        print(f"🎵 Начинаем обработку {len(files)} файлов в формате {output_format.upper()}")
+        ensure_job_workers()
+        _job_wakeup.set()
         
-        # Создаем временную директорию для обработки
-        temp_dir = tempfile.mkdtemp()
-        processed_files = []
+        return jsonify(job_public_view(job_id, job)), 202
         
-        try:
-            for i, (file, speed_str) in enumerate(zip(files, speeds)):
-                if file.filename == '':
-                    continue
-                
-                try:
-                    speed = float(speed_str)
-                    if speed <= 0 or speed > 10:
-                        return jsonify({'error': f'Недопустимая скорость: {speed}'}), 400
-                except ValueError:
-                    return jsonify({'error': f'Недопустимое значение скорости: {speed_str}'}), 400
-                
-                # Сохраняем входной файл
-                input_path = os.path.join(temp_dir, f'input_{i}_{file.filename}')
-                file.save(input_path)
-                
-                # Обрабатываем аудио
-                try:
-                    print(f"📁 Обрабатываем файл {i+1}/{len(files)}: {file.filename}")
-                    print(f"🎛️ Скорость: {speed}x, Формат: {output_format.upper()}")
-                    
-                    processed_audio, sr = process_audio_with_rubberband(
-                        input_path, speed, preserve_pitch
-                    )
-                    
-                    print(f"🔧 Нормализация аудио...")
-                    # Нормализуем
-                    processed_audio = normalize_audio(processed_audio)
-                    
-                    # Определяем имя и путь выходного файла в зависимости от формата
-                    base_name = os.path.splitext(file.filename)[0]
-                    output_filename = f"{base_name}_slowed.{output_format}"
-                    output_path = os.path.join(temp_dir, output_filename)
-                    
-                    # Сохраняем результат в выбранном формате
-                    print(f"💾 Сохраняем результат в формате {output_format.upper()}: {processed_audio.shape}, sr={sr}")
-                    
-                    final_path = save_audio_in_format(output_path, processed_audio, sr, output_format)
-                    processed_files.append((final_path, output_filename))
-                    
-                    print(f"✅ Файл {file.filename} обработан успешно")
-                    
-                except Exception as e:
-                    print(f"❌ Ошибка обработки файла {file.filename}: {e}")
-                    return jsonify({'error': f'Ошибка обработки файла {file.filename}: {str(e)}'}), 500
-            
-            if not processed_files:
-                return jsonify({'error': 'Нет файлов для обработки'}), 400
-            
-            print("📦 Создание ZIP архива...")
-            
-            # Создаем ZIP архив
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for file_path, filename in processed_files:
-                    zip_file.write(file_path, filename)
-            
-            zip_buffer.seek(0)
-            
-            print("✅ Обработка завершена!")
-            
-            return send_file(
-                zip_buffer,
-                mimetype='application/zip',
-                as_attachment=True,
-                download_name='slowed_audio_files.zip'
-            )
-            
-        finally:
-            # Очищаем временные файлы
-            import shutil
-            try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
-                
     except Exception as e:
-        print(f"Общая ошибка: {e}")
+        print(f"❌ Ошибка постановки задачи: {e}")
         return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
 
+@app.route('/progress/<job_id>', methods=['GET'])
+def job_progress(job_id):
+    """Состояние задачи рендеринга"""
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    # Воркер, выполнявший задачу, мог быть перезапущен gunicorn
+    if job['status'] == 'running':
+        job = requeue_orphaned_job(job_id) or job
+    
+    ensure_job_workers()
+    return jsonify(job_public_view(job_id, job))
+
+@app.route('/cancel/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    """Отмена задачи рендеринга"""
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    if job['status'] in ('done', 'failed', 'cancelled'):
+        return jsonify(job_public_view(job_id, job))
+    
+    with open(os.path.join(get_job_dir(job_id), 'cancel'), 'w') as f:
+        f.write(str(time.time()))
+    
+    # Задачу из очереди отменяем сразу, если её ещё никто не забрал
+    if job['status'] == 'queued' and claim_job(job_id):
+        job = update_job(job_id, only_if=('queued',), status='cancelled')
+    
+    print(f"🛑 Запрошена отмена задачи {job_id}")
+    return jsonify(job_public_view(job_id, read_job(job_id) or job))
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def download_job(job_id):
+    """Скачивание ZIP архива завершенной задачи"""
+    job = read_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    
+    if job['status'] != 'done':
+        return jsonify({'error': f'Задача не завершена: {job["status"]}'}), 409
+    
+    return send_file(
+        os.path.join(get_job_dir(job_id), 'result.zip'),
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='slowed_audio_files.zip'
+    )
+
 @app.route('/test', methods=['POST'])
 def test_processing():
     """Тестовый эндпоинт для проверки обработки"""
@@ -1027,58 +3241,544 @@ def test_processing():
         return jsonify({'error': str(e)}), 500
 
 
-def analyze_audio_file(audio_path):
+# Частота дискретизации для анализа: признаки не используют полосу выше
+# ~11 кГц, а STFT и прочее на 22.05 кГц вдвое дешевле. 0 - исходная частота
+ANALYSIS_SAMPLE_RATE = int(os.environ.get('ANALYSIS_SAMPLE_RATE', 22050))
+
+def probe_audio_metadata(audio_path):
+    """
+    Параметры файла по заголовку, без декодирования:
+    {'sr', 'channels', 'duration', 'bit_depth'} или None
+    """
+    if audio_path.lower().endswith('.wav'):
+        try:
+            with MappedWav(audio_path) as wav:
+                return {'sr': wav.sr, 'channels': wav.channels,
+                        'duration': wav.duration, 'bit_depth': wav.bit_depth}
+        except (OSError, ValueError):
+            pass
+    
+    if has_ffmpeg():
+        info = probe_audio_stream(audio_path)
+        if info is not None:
+            return info
+    
+    if HAS_SOUNDFILE:
+        try:
+            info = sf.info(audio_path)
+            bits = re.search(r'(\d+)', info.subtype)
+            return {'sr': info.samplerate, 'channels': info.channels,
+                    'duration': info.frames / info.samplerate if info.samplerate else None,
+                    'bit_depth': int(bits.group(1)) if bits else None}
+        except Exception:
+            pass
+    return None
+
+def downmix_wav_to_mono(wav, block_size=STREAM_BLOCK_SAMPLES):
+    """
+    Сводит WAV в моно float32 блоками через read_block, без промежуточного
+    многоканального массива
+    """
+    mono = np.empty(wav.n_samples, dtype=np.float32)
+    for start in range(0, wav.n_samples, block_size):
+        stop = min(start + block_size, wav.n_samples)
+        np.mean(wav.read_block(start, stop), axis=0, out=mono[start:stop])
+    return mono
+
+def load_analysis_audio(audio_path, content_hash=None, target_sr=ANALYSIS_SAMPLE_RATE):
+    """
+    Моно сигнал на частоте анализа: (y, sr).
+    Сжатые форматы ffmpeg сразу декодирует в моно на нужной частоте;
+    WAV сводится в моно блоками прямо из mmap и ресэмплируется.
+    Результат кэшируется в кэше PCM со своей раскладкой, отдельно от PCM
+    рендеринга
+    """
+    _, ext = os.path.splitext(audio_path.lower())
+    layout = f'mono:{target_sr or "native"}'
+    if ext == '.wav':
+        decoder = 'mmap_wav'
+    elif ext in FFMPEG_DECODE_EXTENSIONS and best_engine('decode', ext) == 'ffmpeg':
+        decoder = 'ffmpeg'
+    else:
+        decoder = 'librosa'
+    
+    # Если быстрый декодер не справился с файлом, сигнал сохранен под ключом
+    # librosa: он проверяется до повторного декодирования
+    for cached_decoder in dict.fromkeys((decoder, 'librosa')):
+        cached = get_cached_pcm(content_hash, cached_decoder, layout)
+        if cached is not None:
+            return cached
+    
+    y = None
+    try:
+        if decoder == 'mmap_wav':
+            with MappedWav(audio_path) as wav:
+                mono = downmix_wav_to_mono(wav)
+                sr = wav.sr
+            y, sr = resample_to_rate(mono, sr, target_sr or sr), target_sr or sr
+        elif decoder == 'ffmpeg':
+            y, sr = decode_audio_with_ffmpeg(audio_path, sr=target_sr or None, channels=1)
+    except Exception as e:
+        print(f"⚠️ Быстрое декодирование для анализа не удалось: {e}")
+    
+    if y is None:
+        # Последний вариант - librosa (audioread), сразу в моно на частоте анализа
+        decoder = 'librosa'
+        y, sr = librosa.load(audio_path, sr=target_sr or None, mono=True)
+    
+    put_cached_pcm(content_hash, decoder, y, sr, layout)
+    return y, sr
+
+class SpectralFeatures:
+    """
+    Общий контекст признаков одного анализа. STFT, мел-спектрограмма и
+    огибающая онсетов считаются один раз при первом обращении, производные
+    признаки librosa строятся из них и запоминаются. Параметры совпадают
+    с умолчаниями librosa (n_fft=2048, hop_length=512), поэтому значения
+    те же, что при вызове функций librosa от сигнала
+    """
+    def __init__(self, y, sr):
+        self.y = y
+        self.sr = sr
+    
+    @cached_property
+    def stft(self):
+        return librosa.stft(self.y)
+    
+    @cached_property
+    def magnitude(self):
+        return np.abs(self.stft)
+    
+    @cached_property
+    def power(self):
+        return self.magnitude ** 2
+    
+    @cached_property
+    def freqs(self):
+        return librosa.fft_frequencies(sr=self.sr)
+    
+    @cached_property
+    def mel_db(self):
+        return librosa.power_to_db(librosa.feature.melspectrogram(S=self.power, sr=self.sr))
+    
+    @cached_property
+    def onset_envelope(self):
+        return librosa.onset.onset_strength(S=self.mel_db, sr=self.sr)
+    
+    @cached_property
+    def onset_envelope_median(self):
+        # beat_track от сигнала агрегирует онсеты по медиане, а не по среднему
+        return librosa.onset.onset_strength(S=self.mel_db, sr=self.sr, aggregate=np.median)
+    
+    @cached_property
+    def chroma(self):
+        return librosa.feature.chroma_stft(S=self.power, sr=self.sr)
+    
+    @cached_property
+    def mfcc(self):
+        return librosa.feature.mfcc(S=self.mel_db, n_mfcc=13)
+    
+    @cached_property
+    def rms(self):
+        # RMS по кадрам сигнала: оценка по оконному спектру дает другие значения
+        return librosa.feature.rms(y=self.y)[0]
+    
+    @cached_property
+    def zcr(self):
+        return librosa.feature.zero_crossing_rate(self.y)[0]
+    
+    @cached_property
+    def centroid(self):
+        return librosa.feature.spectral_centroid(S=self.magnitude, sr=self.sr)[0]
+    
+    @cached_property
+    def bandwidth(self):
+        return librosa.feature.spectral_bandwidth(S=self.magnitude, sr=self.sr)[0]
+    
+    @cached_property
+    def rolloff(self):
+        return librosa.feature.spectral_rolloff(S=self.magnitude, sr=self.sr)[0]
+    
+    @cached_property
+    def contrast(self):
+        return librosa.feature.spectral_contrast(S=self.magnitude, sr=self.sr)
+    
+    @cached_property
+    def flatness(self):
+        return librosa.feature.spectral_flatness(S=self.magnitude)[0]
+    
+    @cached_property
+    def percussive(self):
+        # HPSS по уже посчитанному STFT: нужен только обратный проход
+        _, percussive_stft = librosa.decompose.hpss(self.stft)
+        return librosa.istft(percussive_stft, length=len(self.y))
+
+# Спектрограмма для /analyze: фиолетовая палитра интерфейса, линейная шкала
+# частот до SPECTROGRAM_FMAX, диапазон 80 дБ от максимума трека.
+# Строится пирамида уровней масштаба и отдается тайлами через /spectrogram
+SPECTROGRAM_TILE_WIDTH = int(os.environ.get('SPECTROGRAM_TILE_WIDTH', 512))
+SPECTROGRAM_TILE_HEIGHT = int(os.environ.get('SPECTROGRAM_TILE_HEIGHT', 256))
+SPECTROGRAM_FMAX = float(os.environ.get('SPECTROGRAM_FMAX', 8000))
+SPECTROGRAM_TOP_DB = 80.0
+SPECTROGRAM_COLORS = ['#0a0a0f', '#1a1a2e', '#8b5cf6', '#a78bfa', '#ffffff']
+
+# Версия входит в ключ кэша и ETag тайлов: менять при изменении отрисовки
+SPECTROGRAM_VERSION = '1'
+SPECTROGRAM_CACHE_DIR = os.environ.get('SPECTROGRAM_CACHE_DIR',
+                                       os.path.join(tempfile.gettempdir(), 'slowler_spectrogram_cache'))
+SPECTROGRAM_CACHE_MAX_BYTES = int(os.environ.get('SPECTROGRAM_CACHE_MAX_BYTES', 1024 ** 3))
+
+SPECTROGRAM_CACHE = (DiskLRUCache(SPECTROGRAM_CACHE_DIR, SPECTROGRAM_CACHE_MAX_BYTES)
+                     if SPECTROGRAM_CACHE_MAX_BYTES > 0 else None)
+
+CONTENT_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+@lru_cache(maxsize=None)
+def spectrogram_palette(n_colors=256):
+    """
+    Таблица цветов (n_colors, 3) uint8: линейная интерполяция между
+    опорными цветами, как LinearSegmentedColormap.from_list
+    """
+    anchors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in SPECTROGRAM_COLORS],
+                       dtype=np.float64)
+    positions = np.linspace(0.0, 1.0, len(anchors))
+    x = np.linspace(0.0, 1.0, n_colors)
+    lut = np.rint(np.stack([np.interp(x, positions, anchors[:, k]) for k in range(3)], axis=1))
+    lut = lut.astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+def bin_to_pixels(values, n_pixels, axis):
+    """
+    Приводит ось к n_pixels: среднее по группам бинов/кадров, а если данных
+    меньше, чем пикселей, - повтор ближайшего значения
+    """
+    n = values.shape[axis]
+    if n >= n_pixels:
+        edges = (np.arange(n_pixels) * n) // n_pixels
+        counts = np.diff(np.append(edges, n))
+        shape = [1] * values.ndim
+        shape[axis] = n_pixels
+        return np.add.reduceat(values, edges, axis=axis) / counts.reshape(shape)
+    return np.take(values, (np.arange(n_pixels) * n) // n_pixels, axis=axis)
+
+def spectrogram_indices(power, ref, width, height):
+    """
+    Индексы палитры (height, width) uint8 из спектра мощности (bins, frames):
+    мощность усредняется по пикселям и переводится в дБ относительно ref.
+    Низкие частоты внизу
+    """
+    power = bin_to_pixels(bin_to_pixels(power, width, axis=1), height, axis=0)
+    db = 10.0 * np.log10(np.maximum(power, 1e-10) / ref)
+    
+    levels = len(spectrogram_palette()) - 1
+    index = np.rint((db + SPECTROGRAM_TOP_DB) * (levels / SPECTROGRAM_TOP_DB))
+    return np.clip(index, 0, levels).astype(np.uint8)[::-1]
+
+def build_spectrogram_pyramid(magnitude, sr, fmax=SPECTROGRAM_FMAX,
+                              tile_width=SPECTROGRAM_TILE_WIDTH, tile_height=SPECTROGRAM_TILE_HEIGHT):
+    """
+    Пирамида спектрограммы: на уровне z трек делится на 2^z тайлов по
+    времени и по частоте, пока пиксель не станет мельче кадра или бина
+    STFT. Цвета всех уровней считаются от общего максимума трека.
+    Возвращает список изображений уровней (индексы палитры)
+    """
+    freqs = np.linspace(0.0, sr / 2.0, magnitude.shape[0])
+    visible = magnitude[:max(int(np.searchsorted(freqs, fmax, side='right')), 1)]
+    power = np.square(visible, dtype=np.float32)
+    ref = max(float(np.max(power)), 1e-10)
+    
+    max_x = max(1, -(-power.shape[1] // tile_width))
+    max_y = max(1, -(-power.shape[0] // tile_height))
+    
+    levels = []
+    while True:
+        tiles_x = min(2 ** len(levels), max_x)
+        tiles_y = min(2 ** len(levels), max_y)
+        levels.append(spectrogram_indices(power, ref, tiles_x * tile_width, tiles_y * tile_height))
+        if tiles_x == max_x and tiles_y == max_y:
+            return levels
+
+def store_spectrogram_pyramid(content_hash, levels, sr, duration):
+    """
+    Сохраняет пирамиду в кэш: уровни подряд в одном .npy (открывается
+    через mmap) и описание уровней в .json. Возвращает описание или None
+    """
+    if SPECTROGRAM_CACHE is None or not content_hash:
+        return None
+    
+    meta = {
+        'version': SPECTROGRAM_VERSION,
+        'tile_width': SPECTROGRAM_TILE_WIDTH,
+        'tile_height': SPECTROGRAM_TILE_HEIGHT,
+        'fmax': min(SPECTROGRAM_FMAX, sr / 2.0),
+        'duration': duration,
+        'levels': []
+    }
+    offset = 0
+    for image in levels:
+        height, width = image.shape
+        meta['levels'].append({
+            'offset': offset, 'width': width, 'height': height,
+            'tiles_x': width // SPECTROGRAM_TILE_WIDTH, 'tiles_y': height // SPECTROGRAM_TILE_HEIGHT
+        })
+        offset += image.size
+    
+    key = spectrogram_cache_key(content_hash)
+    token = f'{os.getpid()}.{threading.get_ident()}'
+    data_tmp = os.path.join(SPECTROGRAM_CACHE.directory, f'{key}.{token}.npy.tmp')
+    meta_tmp = os.path.join(SPECTROGRAM_CACHE.directory, f'{key}.{token}.json.tmp')
+    try:
+        with open(data_tmp, 'wb') as f:
+            np.save(f, np.concatenate([image.ravel() for image in levels]))
+        with open(meta_tmp, 'w') as f:
+            json.dump(meta, f)
+        # Сначала данные, затем описание: запись без описания считается промахом
+        SPECTROGRAM_CACHE.put(key, '.npy', data_tmp, move=True)
+        SPECTROGRAM_CACHE.put(key, '.json', meta_tmp, move=True)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить спектрограмму в кэш: {e}")
+        return None
+    finally:
+        for path in (data_tmp, meta_tmp):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return meta
+
+def spectrogram_cache_key(content_hash):
+    return hashlib.sha256(f'{SPECTROGRAM_VERSION}:{content_hash}'.encode()).hexdigest()
+
+def load_spectrogram_meta(content_hash):
+    """
+    Описание пирамиды из кэша или None
+    """
+    if SPECTROGRAM_CACHE is None or not content_hash:
+        return None
+    key = spectrogram_cache_key(content_hash)
+    meta_path = SPECTROGRAM_CACHE.get(key, '.json')
+    if meta_path is None or SPECTROGRAM_CACHE.get(key, '.npy') is None:
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_spectrogram_tile(content_hash, level, x, y):
+    """
+    PNG тайла (level, x, y) или None; y = 0 - верхний (высокие частоты) ряд
+    """
+    meta = load_spectrogram_meta(content_hash)
+    if meta is None or not 0 <= level < len(meta['levels']):
+        return None
+    info = meta['levels'][level]
+    if not (0 <= x < info['tiles_x'] and 0 <= y < info['tiles_y']):
+        return None
+    
+    data_path = SPECTROGRAM_CACHE.get(spectrogram_cache_key(content_hash), '.npy')
+    if data_path is None:
+        return None
+    try:
+        data = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    
+    image = data[info['offset']:info['offset'] + info['width'] * info['height']]
+    image = image.reshape(info['height'], info['width'])
+    tile_width, tile_height = meta['tile_width'], meta['tile_height']
+    tile = image[y * tile_height:(y + 1) * tile_height, x * tile_width:(x + 1) * tile_width]
+    return encode_png(tile, spectrogram_palette())
+
+def spectrogram_tiles_info(content_hash, meta):
+    """
+    Описание пирамиды для клиента: шаблон URL тайлов и сетка уровней
+    """
+    return {
+        'url': f'/spectrogram/{content_hash}/{{level}}/{{x}}/{{y}}.png',
+        'tile_width': meta['tile_width'],
+        'tile_height': meta['tile_height'],
+        'fmax': meta['fmax'],
+        'duration': meta['duration'],
+        'levels': [{'tiles_x': level['tiles_x'], 'tiles_y': level['tiles_y']} for level in meta['levels']]
+    }
+
+def encode_png(indices, palette):
+    """
+    PNG с палитрой (8 бит на пиксель) без сторонних библиотек: байт на
+    пиксель вместо трех для RGB, строки без фильтра сжимаются zlib
+    """
+    height, width = indices.shape
+    rows = np.empty((height, width + 1), dtype=np.uint8)
+    rows[:, 0] = 0
+    rows[:, 1:] = indices
+    
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+            + chunk(b'PLTE', np.ascontiguousarray(palette, dtype=np.uint8).tobytes())
+            + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+# Кэш результатов /analyze: ключ - хэш содержимого, расширение файла и
+# версия параметров анализа. Перед дисковым кэшем - LRU в памяти воркера
+ANALYSIS_VERSION = '2'
+ANALYSIS_CACHE_DIR = os.environ.get('ANALYSIS_CACHE_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'slowler_analysis_cache'))
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get('ANALYSIS_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+ANALYSIS_MEMORY_CACHE_SIZE = int(os.environ.get('ANALYSIS_MEMORY_CACHE_SIZE', 256))
+
+ANALYSIS_CACHE = (DiskLRUCache(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_MAX_BYTES)
+                  if ANALYSIS_CACHE_MAX_BYTES > 0 else None)
+
+class MemoryLRUCache:
+    """
+    Небольшой LRU словарь в памяти процесса, безопасный для потоков
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+ANALYSIS_MEMORY_CACHE = MemoryLRUCache(ANALYSIS_MEMORY_CACHE_SIZE)
+
+def analysis_cache_key(content_hash, extension):
+    raw = (f'{ANALYSIS_VERSION}:{ANALYSIS_SAMPLE_RATE}:{SPECTROGRAM_VERSION}:'
+           f'{extension}:{content_hash}')
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def analysis_has_tiles(result):
+    return bool(result.get('spectral_analysis', {}).get('spectrogram_tiles'))
+
+def get_cached_analysis(content_hash, extension):
+    """
+    Готовый результат анализа или None. Результат без тайлов спектрограммы
+    (не построены или вытеснены из своего кэша) считается промахом - анализ
+    их перестроит
+    """
+    if not content_hash:
+        return None
+    key = analysis_cache_key(content_hash, extension)
+    
+    result = ANALYSIS_MEMORY_CACHE.get(key)
+    source = 'memory'
+    if result is None and ANALYSIS_CACHE is not None:
+        path = ANALYSIS_CACHE.get(key, '.json')
+        if path is not None:
+            try:
+                with open(path, 'r') as f:
+                    result = json.load(f)
+                source = 'disk'
+            except (OSError, ValueError):
+                result = None
+    if result is None:
+        return None
+    
+    if SPECTROGRAM_CACHE is not None and (not analysis_has_tiles(result)
+                                          or load_spectrogram_meta(content_hash) is None):
+        return None
+    
+    if source == 'disk':
+        ANALYSIS_MEMORY_CACHE.put(key, result)
+    count_analysis(source)
+    print(f"⚡ Результат анализа найден в кэше ({source})")
+    return result
+
+def put_cached_analysis(content_hash, extension, result):
     """
-    Анализ аудио файла для получения аналитических данных
+    Сохраняет успешный результат анализа в память и на диск. Результат без
+    тайлов (сбой построения спектрограммы) не кэшируется, иначе тайлы для
+    трека не появились бы никогда
     """
+    if not content_hash or not result.get('success'):
+        return
+    if SPECTROGRAM_CACHE is not None and not analysis_has_tiles(result):
+        return
+    key = analysis_cache_key(content_hash, extension)
+    ANALYSIS_MEMORY_CACHE.put(key, result)
+    if ANALYSIS_CACHE is None:
+        return
+    
+    tmp_path = os.path.join(ANALYSIS_CACHE.directory, f'{key}.{os.getpid()}.{threading.get_ident()}.json.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        ANALYSIS_CACHE.put(key, '.json', tmp_path, move=True)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"⚠️ Не удалось сохранить анализ в кэш: {e}")
+    finally:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+def analyze_audio_file(audio_path, content_hash=None):
+    """
+    Анализ аудио файла для получения аналитических данных.
+    Повторный анализ того же трека отдается из кэша результатов
+    """
+    _, ext = os.path.splitext(audio_path.lower())
+    cached = get_cached_analysis(content_hash, ext)
+    if cached is not None:
+        return cached
+    
     try:
         print(f"🔍 Анализируем аудио файл: {audio_path}")
+        clock = StageClock('analyze')
+        count_analysis('miss')
         
-        # Загружаем аудио файл
-        y, sr = librosa.load(audio_path, sr=None, mono=False)
+        # Моно на частоте анализа (ANALYSIS_SAMPLE_RATE)
+        y_mono, sr = load_analysis_audio(audio_path, content_hash)
+        clock.lap('decode')
         
-        # Если стерео, берем среднее для анализа
-        if y.ndim == 2:
-            y_mono = np.mean(y, axis=0)
-        else:
-            y_mono = y
+        # Все спектральные признаки считаются из одного STFT
+        features = SpectralFeatures(y_mono, sr)
         
-        # Базовая информация о файле
-        duration = len(y_mono) / sr
+        # Базовая информация о файле - по заголовку, а не по декодированному сигналу
+        metadata = probe_audio_metadata(audio_path) or {}
+        duration = metadata.get('duration') or len(y_mono) / sr
         file_size = os.path.getsize(audio_path)
         
         # Определяем формат файла
-        _, ext = os.path.splitext(audio_path.lower())
         audio_format = ext[1:].upper() if ext else 'Unknown'
         
-        # Определяем разрядность (приблизительно)
-        bit_depth = 16  # По умолчанию для большинства файлов
-        if audio_format == 'WAV':
-            try:
-                from scipy.io import wavfile
-                _, data = wavfile.read(audio_path)
-                if data.dtype == np.int16:
-                    bit_depth = 16
-                elif data.dtype == np.int32:
-                    bit_depth = 32
-                elif data.dtype == np.float32:
-                    bit_depth = 32
-            except:
-                pass
+        # Разрядность из заголовка; 16 - по умолчанию для большинства файлов
+        bit_depth = metadata.get('bit_depth') or 16
         
         # Анализ BPM (темп)
         print("🥁 Анализируем BPM...")
         try:
-            tempo, beats = librosa.beat.beat_track(y=y_mono, sr=sr)
-            bpm = float(tempo)
+            tempo, beats = librosa.beat.beat_track(onset_envelope=features.onset_envelope_median, sr=sr)
+            bpm = float(np.ravel(tempo)[0])
         except:
             bpm = None
+        clock.lap('bpm')
         
         # Анализ тональности
         print("🎼 Анализируем тональность...")
         try:
             # Используем chroma features для определения тональности
-            chroma = librosa.feature.chroma_stft(y=y_mono, sr=sr)
+            chroma = features.chroma
             chroma_mean = np.mean(chroma, axis=1)
             
             # Определяем основную тональность
@@ -1107,74 +3807,37 @@ def analyze_audio_file(audio_path):
         except Exception as e:
             print(f"⚠️ Ошибка анализа тональности: {e}")
             key_signature = "Unknown"
+        clock.lap('key')
         
-        # Спектральный анализ
+        # Спектральный анализ: пирамида тайлов строится один раз на трек
         print("📊 Создаем спектрограмму...")
         try:
-            # Создаем спектрограмму
-            D = librosa.stft(y_mono)
-            S_db = librosa.amplitude_to_db(np.abs(D), ref=np.max)
-            
-            # Создаем изображение спектрограммы
-            plt.figure(figsize=(12, 6))
-            plt.style.use('dark_background')
-            
-            # Настраиваем цветовую схему
-            colors = ['#0a0a0f', '#1a1a2e', '#8b5cf6', '#a78bfa', '#ffffff']
-            n_bins = 256
-            cmap = LinearSegmentedColormap.from_list('custom', colors, N=n_bins)
-            
-            librosa.display.specshow(
-                S_db, 
-                sr=sr, 
-                x_axis='time', 
-                y_axis='hz',
-                cmap=cmap,
-                fmax=8000  # Ограничиваем частоты для лучшей визуализации
-            )
-            
-            plt.colorbar(format='%+2.0f dB', label='Amplitude (dB)')
-            plt.title('Спектрограмма', color='white', fontsize=14, pad=20)
-            plt.xlabel('Время (с)', color='white')
-            plt.ylabel('Частота (Гц)', color='white')
-            
-            # Настраиваем внешний вид
-            plt.gca().set_facecolor('#0a0a0f')
-            plt.gcf().patch.set_facecolor('#0a0a0f')
-            plt.tick_params(colors='white')
-            
-            # Сохраняем в буфер
-            buffer = io.BytesIO()
-            plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight', 
-                       facecolor='#0a0a0f', edgecolor='none')
-            buffer.seek(0)
-            
-            # Кодируем в base64
-            spectrogram_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            plt.close()
+            spectrogram_meta = load_spectrogram_meta(content_hash)
+            if spectrogram_meta is None and content_hash:
+                levels = build_spectrogram_pyramid(features.magnitude, sr)
+                spectrogram_meta = store_spectrogram_pyramid(content_hash, levels, sr, duration)
+            spectrogram_tiles = (spectrogram_tiles_info(content_hash, spectrogram_meta)
+                                 if spectrogram_meta is not None else None)
             
         except Exception as e:
             print(f"⚠️ Ошибка создания спектрограммы: {e}")
-            spectrogram_base64 = None
+            spectrogram_tiles = None
+        clock.lap('spectrogram')
         
         # Дополнительные аналитические данные
         print("📈 Вычисляем дополнительные метрики...")
         try:
             # RMS энергия
-            rms = librosa.feature.rms(y=y_mono)[0]
-            avg_rms = float(np.mean(rms))
+            avg_rms = float(np.mean(features.rms))
             
             # Спектральный центроид (яркость)
-            spectral_centroids = librosa.feature.spectral_centroid(y=y_mono, sr=sr)[0]
-            avg_spectral_centroid = float(np.mean(spectral_centroids))
+            avg_spectral_centroid = float(np.mean(features.centroid))
             
             # Zero crossing rate (характеризует перкуссивность)
-            zcr = librosa.feature.zero_crossing_rate(y_mono)[0]
-            avg_zcr = float(np.mean(zcr))
+            avg_zcr = float(np.mean(features.zcr))
             
             # Спектральная полоса пропускания
-            spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y_mono, sr=sr)[0]
-            avg_bandwidth = float(np.mean(spectral_bandwidth))
+            avg_bandwidth = float(np.mean(features.bandwidth))
             
         except Exception as e:
             print(f"⚠️ Ошибка вычисления метрик: {e}")
@@ -1182,40 +3845,38 @@ def analyze_audio_file(audio_path):
             avg_spectral_centroid = None
             avg_zcr = None
             avg_bandwidth = None
+        clock.lap('features')
         
         # Вычисляем расширенные характеристики для анализа жанра
         try:
             print("🎼 Анализируем расширенные характеристики...")
             
             # Спектральный роллофф (частота, ниже которой содержится 85% энергии)
-            rolloff = librosa.feature.spectral_rolloff(y=y_mono, sr=sr)[0]
-            avg_rolloff = float(np.mean(rolloff))
+            avg_rolloff = float(np.mean(features.rolloff))
             
             # MFCC (мел-частотные кепстральные коэффициенты)
-            mfccs = librosa.feature.mfcc(y=y_mono, sr=sr, n_mfcc=13)
-            mfcc_mean = np.mean(mfccs, axis=1)
+            mfcc_mean = np.mean(features.mfcc, axis=1)
             
             # Спектральный контраст
-            contrast = librosa.feature.spectral_contrast(y=y_mono, sr=sr)
-            avg_contrast = float(np.mean(contrast))
+            avg_contrast = float(np.mean(features.contrast))
             
             # Анализ частотного баланса
-            freq_balance = analyze_frequency_balance(y_mono, sr)
+            freq_balance = analyze_frequency_balance(features)
             
             # Анализ гармонической сложности
-            harmonic_complexity = analyze_harmonic_complexity(y_mono, sr)
+            harmonic_complexity = analyze_harmonic_complexity(features)
             
             # Анализ ритмической регулярности
-            rhythmic_regularity = analyze_rhythmic_regularity(y_mono, sr)
+            rhythmic_regularity = analyze_rhythmic_regularity(features)
             
             # Анализ вероятности наличия вокала
-            vocal_likelihood = analyze_vocal_presence(y_mono, sr, mfccs)
+            vocal_likelihood = analyze_vocal_presence(features)
             
             # Анализ перкуссивности
-            percussive_strength = analyze_percussive_strength(y_mono, sr)
+            percussive_strength = analyze_percussive_strength(features)
             
             # Анализ присутствия синтезаторов
-            synth_presence = analyze_synth_presence(y_mono, sr, mfccs, avg_contrast)
+            synth_presence = analyze_synth_presence(features, avg_contrast)
             
             # Собираем все расширенные характеристики
             extended_features = {
@@ -1247,6 +3908,7 @@ def analyze_audio_file(audio_path):
                 'percussive_strength': 0.6,
                 'synth_presence': 0.5
             }
+        clock.lap('extended_features')
 
         # Анализ жанра
         print("🎭 Анализируем жанр...")
@@ -1259,14 +3921,17 @@ def analyze_audio_file(audio_path):
                 'confidence': 0.0,
                 'genre_probabilities': {}
             }
+        clock.lap('genre')
         
         # Формируем результат
         analysis_result = {
             'success': True,
             'basic_info': {
                 'duration': round(duration, 2),
-                'sample_rate': int(sr),
-                'channels': y.shape[0] if y.ndim == 2 else 1,
+                # Без заголовка параметры файла неизвестны: частота анализа и
+                # моно-сигнал анализа о самом файле ничего не говорят
+                'sample_rate': int(metadata['sr']) if metadata.get('sr') else None,
+                'channels': int(metadata['channels']) if metadata.get('channels') else None,
                 'file_size': file_size,
                 'format': audio_format,
                 'bit_depth': bit_depth
@@ -1280,7 +3945,7 @@ def analyze_audio_file(audio_path):
                 'genre_probabilities': genre_info['genre_probabilities']
             },
             'spectral_analysis': {
-                'spectrogram': spectrogram_base64,
+                'spectrogram_tiles': spectrogram_tiles,
                 'avg_rms': round(avg_rms, 4) if avg_rms else None,
                 'spectral_centroid': round(avg_spectral_centroid, 1) if avg_spectral_centroid else None,
                 'zero_crossing_rate': round(avg_zcr, 4) if avg_zcr else None,
@@ -1289,6 +3954,7 @@ def analyze_audio_file(audio_path):
         }
         
         print("✅ Анализ аудио завершен успешно")
+        put_cached_analysis(content_hash, ext, analysis_result)
         return analysis_result
         
     except Exception as e:
@@ -1609,57 +4275,8 @@ def analyze_genre(y, sr, bpm, spectral_centroid, zcr, rms, bandwidth, extended_f
         }
     }
     
-    # Вычисляем расширенные характеристики для анализа жанра
-    try:
-        print("🎼 Анализируем расширенные характеристики...")
-        
-        # Спектральный роллофф (частота, ниже которой содержится 85% энергии)
-        rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)[0]
-        avg_rolloff = float(np.mean(rolloff))
-        
-        # MFCC (мел-частотные кепстральные коэффициенты)
-        mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-        mfcc_mean = np.mean(mfccs, axis=1)
-        
-        # Спектральный контраст
-        contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-        avg_contrast = float(np.mean(contrast))
-        
-        # Анализ частотного баланса
-        freq_balance = analyze_frequency_balance(y, sr)
-        
-        # Анализ гармонической сложности
-        harmonic_complexity = analyze_harmonic_complexity(y, sr)
-        
-        # Анализ ритмической регулярности
-        rhythmic_regularity = analyze_rhythmic_regularity(y, sr)
-        
-        # Анализ вероятности наличия вокала
-        vocal_likelihood = analyze_vocal_presence(y, sr, mfccs)
-        
-        # Анализ перкуссивности
-        percussive_strength = analyze_percussive_strength(y, sr)
-        
-        # Анализ присутствия синтезаторов
-        synth_presence = analyze_synth_presence(y, sr, mfccs, avg_contrast)
-        
-        # Собираем все расширенные характеристики
-        extended_features = {
-            'rolloff': avg_rolloff,
-            'mfcc_mean': mfcc_mean,
-            'contrast': avg_contrast,
-            'bass_emphasis': freq_balance['bass_emphasis'],
-            'mid_freq_balance': freq_balance['mid_freq_balance'],
-            'high_freq_presence': freq_balance['high_freq_presence'],
-            'harmonic_complexity': harmonic_complexity,
-            'rhythmic_regularity': rhythmic_regularity,
-            'vocal_likelihood': vocal_likelihood,
-            'percussive_strength': percussive_strength,
-            'synth_presence': synth_presence
-        }
-        
-    except Exception as e:
-        print(f"⚠️ Ошибка вычисления расширенных характеристик: {e}")
+    # Расширенные характеристики уже посчитаны в analyze_audio_file
+    if extended_features is None:
         extended_features = {
             'rolloff': None,
             'mfcc_mean': None,
@@ -1840,17 +4457,16 @@ def analyze_genre(y, sr, bpm, spectral_centroid, zcr, rms, bandwidth, extended_f
             'genre_probabilities': {}
         }
 
-def analyze_frequency_balance(y, sr):
+def analyze_frequency_balance(features):
     """
     Анализ баланса частот: бас, средние и высокие частоты
     """
     try:
-        # Вычисляем спектр
-        D = librosa.stft(y)
-        magnitude = np.abs(D)
+        # Спектр из общего контекста признаков
+        magnitude = features.magnitude
         
         # Определяем частотные диапазоны
-        freqs = librosa.fft_frequencies(sr=sr)
+        freqs = features.freqs
         
         # Басовые частоты (20-250 Hz)
         bass_mask = (freqs >= 20) & (freqs <= 250)
@@ -1890,13 +4506,13 @@ def analyze_frequency_balance(y, sr):
             'high_freq_presence': 0.33
         }
 
-def analyze_harmonic_complexity(y, sr):
+def analyze_harmonic_complexity(features):
     """
     Анализ гармонической сложности на основе chroma и тональной стабильности
     """
     try:
-        # Chroma features для анализа гармонии
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+        # Chroma features для анализа гармонии (те же, что и для тональности)
+        chroma = features.chroma
         
         # Вычисляем стандартное отклонение chroma (показатель сложности)
         chroma_std = np.std(chroma, axis=1)
@@ -1918,14 +4534,14 @@ def analyze_harmonic_complexity(y, sr):
         print(f"⚠️ Ошибка анализа гармонической сложности: {e}")
         return 0.5
 
-def analyze_rhythmic_regularity(y, sr):
+def analyze_rhythmic_regularity(features):
     """
     Анализ ритмической регулярности на основе onset detection и beat tracking
     """
     try:
-        # Детекция onset'ов (начал нот/ударов)
-        onset_frames = librosa.onset.onset_detect(y=y, sr=sr)
-        onset_times = librosa.frames_to_time(onset_frames, sr=sr)
+        # Детекция onset'ов (начал нот/ударов) по общей огибающей
+        onset_frames = librosa.onset.onset_detect(onset_envelope=features.onset_envelope, sr=features.sr)
+        onset_times = librosa.frames_to_time(onset_frames, sr=features.sr)
         
         if len(onset_times) < 3:
             return 0.5  # Недостаточно данных
@@ -1954,11 +4570,13 @@ def analyze_rhythmic_regularity(y, sr):
         print(f"⚠️ Ошибка анализа ритмической регулярности: {e}")
         return 0.7
 
-def analyze_vocal_presence(y, sr, mfccs):
+def analyze_vocal_presence(features):
     """
     Анализ вероятности наличия вокала на основе MFCC и спектральных характеристик
     """
     try:
+        mfccs = features.mfcc
+        
         # MFCC характеристики, типичные для вокала
         # Первые несколько MFCC коэффициентов содержат информацию о формантах
         if mfccs is not None and len(mfccs) >= 4:
@@ -1987,8 +4605,7 @@ def analyze_vocal_presence(y, sr, mfccs):
         # Дополнительный анализ через спектральные характеристики
         try:
             # Спектральный центроид в диапазоне человеческого голоса
-            spectral_centroids = librosa.feature.spectral_centroid(y=y, sr=sr)[0]
-            avg_centroid = np.mean(spectral_centroids)
+            avg_centroid = np.mean(features.centroid)
             
             # Человеческий голос обычно в диапазоне 500-4000 Hz
             if 500 <= avg_centroid <= 4000:
@@ -2003,17 +4620,17 @@ def analyze_vocal_presence(y, sr, mfccs):
         print(f"⚠️ Ошибка анализа вокального присутствия: {e}")
         return 0.3
 
-def analyze_percussive_strength(y, sr):
+def analyze_percussive_strength(features):
     """
     Анализ силы перкуссивных элементов
     """
     try:
-        # Разделяем на гармонические и перкуссивные компоненты
-        y_harmonic, y_percussive = librosa.effects.hpss(y)
+        # Перкуссивная компонента HPSS
+        y_percussive = features.percussive
         
         # Вычисляем энергию перкуссивных компонентов
         percussive_energy = np.mean(y_percussive ** 2)
-        total_energy = np.mean(y ** 2)
+        total_energy = np.mean(features.y ** 2)
         
         if total_energy > 0:
             percussive_ratio = percussive_energy / total_energy
@@ -2022,8 +4639,7 @@ def analyze_percussive_strength(y, sr):
         
         # Дополнительно анализируем onset strength
         try:
-            onset_strength = librosa.onset.onset_strength(y=y, sr=sr)
-            avg_onset_strength = np.mean(onset_strength)
+            avg_onset_strength = np.mean(features.onset_envelope)
             
             # Нормализуем и комбинируем с перкуссивным соотношением
             normalized_onset = np.clip(avg_onset_strength / 10.0, 0.0, 1.0)
@@ -2037,11 +4653,12 @@ def analyze_percussive_strength(y, sr):
         print(f"⚠️ Ошибка анализа перкуссивной силы: {e}")
         return 0.6
 
-def analyze_synth_presence(y, sr, mfccs, spectral_contrast):
+def analyze_synth_presence(features, spectral_contrast):
     """
     Анализ присутствия синтезаторов на основе спектральных характеристик
     """
     try:
+        mfccs = features.mfcc
         synth_score = 0.0
         
         # Синтезаторы часто имеют высокий спектральный контраст
@@ -2053,8 +4670,7 @@ def analyze_synth_presence(y, sr, mfccs, spectral_contrast):
         
         # Анализ спектрального роллоффа
         try:
-            rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr)[0]
-            avg_rolloff = np.mean(rolloff)
+            avg_rolloff = np.mean(features.rolloff)
             
             # Синтезаторы могут иметь расширенный частотный спектр
             if avg_rolloff > 8000:  # Высокие частоты
@@ -2064,8 +4680,7 @@ def analyze_synth_presence(y, sr, mfccs, spectral_contrast):
         
         # Анализ спектральной плоскости (flatness)
         try:
-            spectral_flatness = librosa.feature.spectral_flatness(y=y)[0]
-            avg_flatness = np.mean(spectral_flatness)
+            avg_flatness = np.mean(features.flatness)
             
             # Синтезаторы могут иметь более "плоский" спектр
             if avg_flatness > 0.1:
@@ -2084,8 +4699,7 @@ def analyze_synth_presence(y, sr, mfccs, spectral_contrast):
         
         # Анализ zero crossing rate (уже есть в основных параметрах)
         try:
-            zcr = librosa.feature.zero_crossing_rate(y)[0]
-            avg_zcr = np.mean(zcr)
+            avg_zcr = np.mean(features.zcr)
             
             # Синтезаторы могут иметь характерные ZCR паттерны
             if 0.05 <= avg_zcr <= 0.3:
@@ -2144,14 +4758,15 @@ def analyze_audio():
         temp_dir = tempfile.mkdtemp()
         
         try:
-            # Сохраняем файл
+            # Сохраняем файл, попутно считая хэш содержимого для кэша
             input_path = os.path.join(temp_dir, file.filename)
-            file.save(input_path)
+            with stage_timer('analyze', 'upload_save'):
+                content_hash = save_upload_with_hash(file, input_path)
             
             print(f"🔍 Начинаем анализ файла: {file.filename}")
             
             # Анализируем файл
-            analysis_result = analyze_audio_file(input_path)
+            analysis_result = analyze_audio_file(input_path, content_hash)
             
             return jsonify(analysis_result)
             
@@ -2175,5 +4790,10 @@ if __name__ == '__main__':
     print("   3. Простая интерполяция (последний fallback)")
     print("🌐 Сервер доступен на http://localhost:5230")
     
+    # Обработчики задач - только в процессе сервера, а не в наблюдателе перезагрузчика
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ensure_job_workers()
+        start_metrics_server()
+    
     # Запускаем обычный Flask сервер
     app.run(debug=True, host='0.0.0.0', port=5230)
@@ -0,0 +1,221 @@
+"""
+Бенчмарк движков обработки: скорость относительно реального времени,
+перцентили задержки и пиковое потребление памяти.
+
+Каждый прогон (движок, сигнал, скорость) выполняется в отдельном процессе,
+чтобы пиковый RSS не смешивался между движками. Тестовые сигналы
+синтетические и детерминированные: результаты сравнимы между запусками.
+
+Примеры:
+    python benchmark.py
+    python benchmark.py --engines custom_stft,resampling --speeds 0.5,0.8 \\
+        --durations 10,60 --rates 44100,48000 --channels 1,2 --output bench.json
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+SIGNALS = ('tone', 'noise', 'drums')
+
+ENGINES = ('rubberband', 'custom_stft', 'stft', 'resampling', 'simple')
+
+def generate_signal(kind, duration, sr, channels):
+    """
+    Детерминированный тестовый сигнал (channels, samples) float32:
+    tone - аккорд с вибрато, noise - розовый шум, drums - бочка, малый
+    барабан и хэт в темпе 120 BPM. Каналы немного различаются
+    """
+    n = int(duration * sr)
+    t = np.arange(n, dtype=np.float64) / sr
+    seed = sum(map(ord, kind)) * 1000003 + n * 31 + sr + channels
+    rng = np.random.default_rng(seed)
+    out = np.empty((channels, n), dtype=np.float32)
+
+    for channel in range(channels):
+        if kind == 'tone':
+            vibrato = 0.003 * np.sin(2 * np.pi * 5.0 * t)
+            audio = sum(
+                np.sin(2 * np.pi * freq * (1.0 + vibrato) * t + channel * 0.3) / (i + 1)
+                for i, freq in enumerate((220.0, 277.18, 329.63, 440.0))
+            )
+        elif kind == 'noise':
+            # Розовый шум: белый шум с наклоном спектра 1/f
+            spectrum = np.fft.rfft(rng.standard_normal(n))
+            freqs = np.fft.rfftfreq(n, 1.0 / sr)
+            freqs[0] = freqs[1] if n > 1 else 1.0
+            audio = np.fft.irfft(spectrum / np.sqrt(freqs), n)
+        elif kind == 'drums':
+            audio = np.zeros(n)
+            beat = int(sr * 0.5)
+            for start in range(0, n, beat // 2):
+                step = start // (beat // 2)
+                length = min(int(sr * 0.25), n - start)
+                local = t[:length]
+                if step % 4 == 0:
+                    # Бочка: синус с падающей частотой
+                    hit = np.sin(2 * np.pi * (50 + 100 * np.exp(-local * 30)) * local) * np.exp(-local * 12)
+                elif step % 4 == 2:
+                    # Малый барабан: шум с тоном
+                    hit = (rng.standard_normal(length) * 0.6 + np.sin(2 * np.pi * 180 * local)) * np.exp(-local * 20)
+                else:
+                    # Хэт: короткий шум
+                    hit = rng.standard_normal(length) * np.exp(-local * 80) * 0.4
+                audio[start:start + length] += hit
+        else:
+            raise ValueError(f"Неизвестный сигнал: {kind}")
+
+        peak = np.max(np.abs(audio)) or 1.0
+        out[channel] = audio * (0.5 / peak)
+
+    return out
+
+def get_engine(name):
+    """
+    Функция движка с единой сигнатурой fn(y, sr, speed) или None,
+    если движок недоступен в этом окружении
+    """
+    import app
+
+    if name == 'rubberband':
+        if not app.has_rubberband_cli():
+            return None
+        return lambda y, sr, speed: app.process_with_rubberband_shm(y, sr, speed, True)[0]
+    if name == 'custom_stft':
+        return lambda y, sr, speed: app.process_with_custom_stft_stretch(y, speed, sr)
+    if name == 'stft':
+        return lambda y, sr, speed: app.process_with_stft_stretch(y, speed, sr)
+    if name == 'resampling':
+        return lambda y, sr, speed: app.process_with_resampling(y, speed, sr)
+    if name == 'simple':
+        return lambda y, sr, speed: app.process_simple_stretch(y, speed)
+    raise ValueError(f"Неизвестный движок: {name}")
+
+def peak_rss_bytes():
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_case(case):
+    """
+    Один прогон в дочернем процессе: прогрев и repeats замеров
+    """
+    # Логи приложения не должны попадать в JSON на stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        fn = get_engine(case['engine'])
+        if fn is None:
+            return {**case, 'status': 'unavailable'}
+
+        y = generate_signal(case['signal'], case['duration'], case['sr'], case['channels'])
+        baseline_rss = peak_rss_bytes()
+
+        fn(y, case['sr'], case['speed'])
+
+        latencies = []
+        for _ in range(case['repeats']):
+            started = time.perf_counter()
+            fn(y, case['sr'], case['speed'])
+            latencies.append(time.perf_counter() - started)
+
+    latencies = np.array(latencies)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        **case,
+        'status': 'ok',
+        'latency_s': {
+            'min': float(latencies.min()),
+            'mean': float(latencies.mean()),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99)
+        },
+        # Во сколько раз быстрее реального времени (по медиане)
+        'x_realtime': float(case['duration'] / p50) if p50 > 0 else None,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'baseline_rss_bytes': baseline_rss
+    }
+
+def spawn_case(case, timeout):
+    """
+    Запускает прогон в отдельном интерпретаторе и разбирает его JSON
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(case)]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env={**os.environ, 'METRICS_ENABLED': '0'})
+    except subprocess.TimeoutExpired:
+        return {**case, 'status': 'timeout'}
+
+    if result.returncode != 0:
+        return {**case, 'status': 'error', 'error': result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк движков обработки аудио')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--signals', default=','.join(SIGNALS))
+    parser.add_argument('--speeds', default='0.5,0.75,1.25,2.0')
+    parser.add_argument('--durations', default='10', help='длительности сигналов в секундах')
+    parser.add_argument('--rates', default='44100')
+    parser.add_argument('--channels', default='2')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', help='файл для JSON отчета (по умолчанию stdout)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(json.loads(args.worker))))
+        return
+
+    grid = itertools.product(
+        parse_list(args.engines), parse_list(args.signals), parse_list(args.durations, float),
+        parse_list(args.rates, int), parse_list(args.channels, int), parse_list(args.speeds, float)
+    )
+
+    results = []
+    for engine, kind, duration, sr, channels, speed in grid:
+        case = {'engine': engine, 'signal': kind, 'duration': duration, 'sr': sr,
+                'channels': channels, 'speed': speed, 'repeats': args.repeats}
+        result = spawn_case(case, args.timeout)
+        results.append(result)
+
+        if result['status'] == 'ok':
+            print(f"⏱️ {engine:<12} {kind:<6} {duration:g}s {sr}Hz {channels}ch x{speed:g}: "
+                  f"{result['x_realtime']:.1f}x realtime, p50 {result['latency_s']['p50'] * 1000:.0f} ms, "
+                  f"peak RSS {result['peak_rss_bytes'] / 1024 ** 2:.0f} MB", file=sys.stderr)
+        else:
+            print(f"⚠️ {engine:<12} {kind:<6} x{speed:g}: {result['status']}", file=sys.stderr)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'results': results
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
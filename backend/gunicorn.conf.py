@@ -1,5 +1,13 @@
 # Gunicorn configuration for handling large file uploads
 import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Prometheus multiprocess mode: workers (and their render pools) write metric
+# files here, the metrics server on METRICS_PORT aggregates them. Must be set
+# before workers import app
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'slowler_metrics'))
 
 # Server socket
 bind = "0.0.0.0:5230"
@@ -41,3 +49,30 @@ tmp_upload_dir = None
 # SSL (if needed)
 keyfile = None
 certfile = None
+
+# Server hooks
+def on_starting(server):
+    # Metrics from a previous run must not be summed into the new one
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def when_ready(server):
+    # Metrics are served by the master on a separate internal port that nginx
+    # never proxies (see METRICS_PORT / METRICS_ADDR in app.py). Importing app
+    # here also lets the forked workers reuse the already loaded module
+    import app
+    app.start_metrics_server()
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # Start the job worker threads with the worker, not on the first /jobs
+    # request, so jobs left by a recycled worker are picked up right away
+    import app
+    app.ensure_job_workers()
@@ -20,6 +20,7 @@ function App() {
   const [analysisData, setAnalysisData] = useState(null);
   const [analyzingFile, setAnalyzingFile] = useState(null);
   const [analysisCache, setAnalysisCache] = useState(new Map());
+  const [spectrogramLevel, setSpectrogramLevel] = useState(0);
   const fileInputRef = useRef(null);
 
   // Проверяем статус бекенда при загрузке
@@ -448,6 +449,7 @@ function App() {
   const closeAnalysisPopup = () => {
     setAnalysisPopup(null);
     setAnalysisData(null);
+    setSpectrogramLevel(0);
   };
 
   const formatDuration = (seconds) => {
@@ -464,6 +466,24 @@ function App() {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
   };
 
+  const spectrogramTileUrl = (tiles, level, x, y) =>
+    tiles.url.replace('{level}', level).replace('{x}', x).replace('{y}', y);
+
+  // Обзорный уровень пирамиды (один тайл на весь трек) как data URL для PDF
+  const loadSpectrogramOverview = async (tiles) => {
+    const response = await fetch(spectrogramTileUrl(tiles, 0, 0, 0));
+    if (!response.ok) {
+      throw new Error(`Спектрограмма недоступна (${response.status})`);
+    }
+    const blob = await response.blob();
+    return new Promise((resolve, reject) => {
+      const reader = new FileReader();
+      reader.onload = () => resolve(reader.result);
+      reader.onerror = () => reject(reader.error);
+      reader.readAsDataURL(blob);
+    });
+  };
+
   const saveAnalysisToPDF = async () => {
     if (!analysisData || !analysisPopup) {
       setMessage('❌ Нет данных для сохранения');
@@ -514,8 +534,8 @@ function App() {
       pdf.setFont('helvetica', 'normal');
       const basicInfo = [
         `Duration: ${formatDuration(analysisData.basic_info.duration)}`,
-        `Sample Rate: ${analysisData.basic_info.sample_rate} Hz`,
-        `Channels: ${analysisData.basic_info.channels === 1 ? 'Mono' : 'Stereo'}`,
+        `Sample Rate: ${analysisData.basic_info.sample_rate ? `${analysisData.basic_info.sample_rate} Hz` : 'Unknown'}`,
+        `Channels: ${analysisData.basic_info.channels == null ? 'Unknown' : analysisData.basic_info.channels === 1 ? 'Mono' : 'Stereo'}`,
         `File Size: ${formatBytes(analysisData.basic_info.file_size)}`,
         `Format: ${analysisData.basic_info.format}`,
         `Bit Depth: ${analysisData.basic_info.bit_depth} bit`
@@ -582,7 +602,7 @@ function App() {
       yPosition += 10;
 
       // Добавляем спектрограмму если есть
-      if (analysisData.spectral_analysis?.spectrogram) {
+      if (analysisData.spectral_analysis?.spectrogram_tiles) {
         // Проверяем, поместится ли спектрограмма на текущей странице
         const spectrogramHeight = 80; // Примерная высота спектрограммы
         if (yPosition + spectrogramHeight > pageHeight - margin) {
@@ -596,8 +616,8 @@ function App() {
         yPosition += 10;
 
         try {
-          // Конвертируем base64 изображение для PDF
-          const imgData = `data:image/png;base64,${analysisData.spectral_analysis.spectrogram}`;
+          // Загружаем обзорный тайл спектрограммы для PDF
+          const imgData = await loadSpectrogramOverview(analysisData.spectral_analysis.spectrogram_tiles);
           const imgWidth = pageWidth - 2 * margin;
           const imgHeight = (imgWidth * 6) / 12; // Пропорции спектрограммы
 
@@ -642,6 +662,13 @@ function App() {
     }
   };
 
+  // Текущий уровень масштаба спектрограммы
+  const spectrogramTiles = analysisData?.spectral_analysis?.spectrogram_tiles;
+  const spectrogramZoomLevel = spectrogramTiles
+    ? Math.min(spectrogramLevel, spectrogramTiles.levels.length - 1)
+    : 0;
+  const spectrogramGrid = spectrogramTiles ? spectrogramTiles.levels[spectrogramZoomLevel] : null;
+
   return (
     <div className="container">
       <div className="header">
@@ -907,15 +934,49 @@ function App() {
               </div>
 
               {/* Спектрограмма */}
-              {analysisData.spectral_analysis?.spectrogram && (
+              {spectrogramTiles && (
                 <div className="analysis-section">
                   <h4>📊 Спектрограмма</h4>
+                  <div className="spectrogram-zoom">
+                    <button
+                      onClick={() => setSpectrogramLevel(spectrogramZoomLevel - 1)}
+                      disabled={spectrogramZoomLevel === 0}
+                      title="Уменьшить"
+                    >
+                      −
+                    </button>
+                    <span>×{spectrogramGrid.tiles_x}</span>
+                    <button
+                      onClick={() => setSpectrogramLevel(spectrogramZoomLevel + 1)}
+                      disabled={spectrogramZoomLevel === spectrogramTiles.levels.length - 1}
+                      title="Увеличить"
+                    >
+                      +
+                    </button>
+                  </div>
                   <div className="spectrogram-container">
-                    <img 
-                      src={`data:image/png;base64,${analysisData.spectral_analysis.spectrogram}`}
-                      alt="Спектрограмма"
-                      className="spectrogram-image"
-                    />
+                    <div className="spectrogram-scroll">
+                      <div
+                        className="spectrogram-tiles"
+                        style={{
+                          width: `${spectrogramGrid.tiles_x * 100}%`,
+                          gridTemplateColumns: `repeat(${spectrogramGrid.tiles_x}, 1fr)`,
+                          gridTemplateRows: `repeat(${spectrogramGrid.tiles_y}, 1fr)`
+                        }}
+                      >
+                        {Array.from({ length: spectrogramGrid.tiles_y }, (_, y) =>
+                          Array.from({ length: spectrogramGrid.tiles_x }, (_, x) => (
+                            <img
+                              key={`${spectrogramZoomLevel}-${x}-${y}`}
+                              src={spectrogramTileUrl(spectrogramTiles, spectrogramZoomLevel, x, y)}
+                              alt=""
+                              loading="lazy"
+                              className="spectrogram-tile"
+                            />
+                          ))
+                        )}
+                      </div>
+                    </div>
                   </div>
                 </div>
               )}
@@ -931,11 +992,11 @@ function App() {
                     </div>
                     <div className="info-item">
                       <span className="info-label">Частота дискретизации:</span>
-                      <span className="info-value">{analysisData.basic_info.sample_rate} Hz</span>
+                      <span className="info-value">{analysisData.basic_info.sample_rate ? `${analysisData.basic_info.sample_rate} Hz` : 'Неизвестно'}</span>
                     </div>
                     <div className="info-item">
                       <span className="info-label">Каналы:</span>
-                      <span className="info-value">{analysisData.basic_info.channels === 1 ? 'Моно' : 'Стерео'}</span>
+                      <span className="info-value">{analysisData.basic_info.channels == null ? 'Неизвестно' : analysisData.basic_info.channels === 1 ? 'Моно' : 'Стерео'}</span>
                     </div>
                     <div className="info-item">
                       <span className="info-label">Размер файла:</span>